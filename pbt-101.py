@@ -5,7 +5,7 @@ INSTRUCTIONS
 ============
 
 Clone this repository, and `pip install pytest hypothesis`.
-Then run `pytest pbt-101.py`.  You should see nine passing tests.
+Then run `pytest pbt-101.py`.  You should see seventeen passing tests.
 (see README.md for more details on installation)
 
 
@@ -19,11 +19,12 @@ Good luck, and enjoy!
 """
 
 import json
+import random
 from collections import Counter
 
 import pytest
 
-from hypothesis import given, strategies as st
+from hypothesis import given, settings, strategies as st
 
 
 ##############################################################################
@@ -274,8 +275,18 @@ class Record(object):
     def __eq__(self, other):
         return type(self) == type(other) and self.value == other.value
 
-    def to_json(self):
-        """Encodes `self.value` as a JSON-string"""
+    def to_json(self, canonical=False):
+        """Encodes `self.value` as a JSON-string
+
+        If `canonical=True`, the string is as compact as possible, with sorted
+        keys and -0.0 written as 0.0, so equal records give identical strings.
+        """
+        if canonical:
+            # json.dumps writes floats with repr(), i.e. the shortest string
+            # which round-trips, so we only need to fix the sign of zero.
+            return json.dumps(
+                _positive_zeros(self.value), sort_keys=True, separators=(",", ":")
+            )
         return json.dumps(self.value, indent=4)
 
     @classmethod
@@ -330,6 +341,956 @@ indeed. However, this is contingent on our ability to compose strategies
 to generate values that suit our needs. It pays off to develop experience
 towards this end.
 """
+
+##############################################################################
+
+"""
+Canonical JSON
+--------------
+`Record.to_json()` is nice to read, but the indentation makes it much bigger
+than it needs to be - and records with equal values can encode to different
+strings, because dictionaries remember their insertion order and -0.0 == 0.0.
+
+`Record.to_json(canonical=True)` fixes both, which makes the output suitable
+for comparing, hashing, or caching.  Both versions are benchmarked below.
+"""
+
+
+def _positive_zeros(value):
+    """Return a copy of a JSON-like value, with -0.0 replaced by 0.0."""
+    if isinstance(value, float) and value == 0:
+        return 0.0
+    if isinstance(value, list):
+        return [_positive_zeros(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _positive_zeros(v) for k, v in value.items()}
+    return value
+
+
+def _shuffled_copy(value):
+    """Return an equal value with dicts in reverse order, and zeros negated."""
+    if isinstance(value, float) and value == 0:
+        return -value
+    if isinstance(value, list):
+        return [_shuffled_copy(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _shuffled_copy(value[k]) for k in reversed(list(value))}
+    return value
+
+
+@given(json_strat)
+def test_canonical_json_is_identical_for_equal_records(value):
+    string = Record(value).to_json(canonical=True)
+    assert Record(_shuffled_copy(value)).to_json(canonical=True) == string
+    assert Record(json.loads(string)).to_json(canonical=True) == string
+
+
+##############################################################################
+
+"""
+Caching results
+---------------
+Back to the extension problem above: if we're sending serialised records to
+an expensive service, we can cache the results under a hash of the canonical
+encoding - so equal records share a cache entry, however they were built.
+
+Recently-used results are kept in memory, up to a total size limit, and if
+you give `RecordCache` a directory it will also save every result there so
+that they survive restarting the program.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+
+class RecordCache(object):
+    """Calls `service(record.to_json(canonical=True))` for each new record,
+    and remembers the results - which must be JSON-serialisable.
+
+    Up to `max_bytes` of UTF-8 encoded results are kept in memory, and all of
+    them in `directory` if given.
+    """
+
+    def __init__(self, service, max_bytes=64 * 2 ** 20, directory=None):
+        self.service = service
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.stats = Counter()
+        self._memory = OrderedDict()  # key -> result as UTF-8 encoded JSON
+        self._memory_bytes = 0
+
+    def __repr__(self):
+        return "<RecordCache with {} results in memory, stats={}>".format(
+            len(self._memory), dict(self.stats)
+        )
+
+    def __call__(self, record):
+        string = record.to_json(canonical=True)
+        key = hashlib.sha256(string.encode("utf-8")).hexdigest()
+        if key in self._memory:
+            self.stats["hits"] += 1
+            self._memory.move_to_end(key)
+            return json.loads(self._memory[key])
+        path = self.directory and os.path.join(self.directory, key + ".json")
+        if path and os.path.exists(path):
+            self.stats["disk_hits"] += 1
+            with open(path) as f:
+                encoded = f.read()
+        else:
+            self.stats["misses"] += 1
+            encoded = json.dumps(self.service(string))
+            if path:
+                # Write to a temporary file and then rename it, so that other
+                # processes never see a partly-written result.
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, "w") as f:
+                    f.write(encoded)
+                os.replace(tmp, path)
+        self._remember(key, encoded)
+        return json.loads(encoded)
+
+    def _remember(self, key, encoded):
+        self._memory[key] = encoded = encoded.encode("utf-8")
+        self._memory_bytes += len(encoded)
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+
+@given(st.lists(st.builds(Record, value=json_strat)), st.integers(0, 100))
+def test_record_cache_matches_service(records, max_bytes):
+    def service(string):
+        # A local stand-in for the expensive service.
+        return [len(string), string[:10]]
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = RecordCache(service, max_bytes, directory)
+        for record in records:
+            assert cache(record) == service(record.to_json(canonical=True))
+        # Thanks to the on-disk tier, each distinct record reached the service
+        # only once - even though we might have evicted it from memory.
+        unique = {r.to_json(canonical=True) for r in records}
+        assert cache.stats["misses"] == len(unique)
+        assert sum(cache.stats.values()) == len(records)
+        memory = cache._memory.values()
+        assert cache._memory_bytes == sum(map(len, memory)) <= max_bytes
+        # And a new cache (e.g. after a restart) can use the saved results.
+        restarted = RecordCache(service, max_bytes, directory)
+        for record in records:
+            restarted(record)
+        assert restarted.stats["misses"] == 0
+
+
+##############################################################################
+
+"""
+Batching requests
+-----------------
+Sending records to a remote service one at a time means that we spend most
+of our time waiting for replies.  Instead, `RecordBatcher` collects records
+into batches - sending each one when it's full, or has waited long enough -
+and keeps several batches in flight at once over a pool of connections.
+
+The protocol is as simple as possible: we send a JSON array of records on a
+line, and the service replies with a JSON array of results on a line.
+`serve_records` is a local stand-in for the service, for tests and benchmarks.
+"""
+
+import asyncio
+
+STREAM_LIMIT = 2 ** 26  # the longest line we'll read, in bytes
+
+
+class RecordBatcher(object):
+    """Submits records to a service in batches, via `await batcher.submit(r)`.
+
+    Use it as an async context manager - leaving the block waits until every
+    submitted record has been sent and answered, then closes the connections.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        max_batch=100,
+        max_delay=0.005,
+        connections=4,
+        max_pending=10000,
+    ):
+        self.host = host
+        self.port = port
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.connections = connections
+        self.max_pending = max_pending
+
+    async def __aenter__(self):
+        self._queue = asyncio.Queue(self.max_pending)
+        # Connections are opened lazily, so the pool starts out "empty" - and
+        # because every batch needs one, this also limits our concurrency.
+        self._pool = asyncio.Queue()
+        for _ in range(self.connections):
+            self._pool.put_nowait(None)
+        self._sending = set()
+        self._batching = asyncio.ensure_future(self._make_batches())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._queue.put(None)
+        await self._batching
+        await asyncio.gather(*self._sending)
+        while not self._pool.empty():
+            connection = self._pool.get_nowait()
+            if connection is not None:
+                connection[1].close()
+                await connection[1].wait_closed()
+
+    async def submit(self, record):
+        """Queue a record, and return a future for the service's reply.
+
+        If too many records are already waiting to be sent, this waits for
+        some space - that's the backpressure which stops us queueing forever.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((record.to_json(canonical=True), future))
+        return future
+
+    async def _make_batches(self):
+        closing = False
+        while not closing:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            closing = self._take_waiting(batch)
+            if len(batch) < self.max_batch and not closing:
+                await asyncio.sleep(self.max_delay)
+                closing = self._take_waiting(batch)
+            connection = await self._pool.get()
+            task = asyncio.ensure_future(self._send(connection, batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _take_waiting(self, batch):
+        """Move queued items into the batch, returning True if we're closing."""
+        while len(batch) < self.max_batch and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _send(self, connection, batch):
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(
+                    self.host, self.port, limit=STREAM_LIMIT
+                )
+            reader, writer = connection
+            writer.write("[{}]\n".format(",".join(s for s, _ in batch)).encode())
+            await writer.drain()
+            results = json.loads(await reader.readline())
+            assert len(results) == len(batch), "wrong number of results"
+            for (_, future), result in zip(batch, results):
+                # The caller may have cancelled it, e.g. with asyncio.wait_for
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if connection is not None:
+                connection[1].close()
+            connection = None  # we'll reconnect next time
+        finally:
+            self._pool.put_nowait(connection)
+
+
+async def serve_records(handler, host="127.0.0.1", port=0, delay=0):
+    """Start a local stand-in for the service, replying to each batch with
+    `[handler(value) for value in batch]` after `delay` seconds.
+
+    Returns an asyncio Server; with the default port=0 the OS will choose a
+    free port, which you can find with `server.sockets[0].getsockname()[1]`.
+    """
+
+    async def respond(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            await asyncio.sleep(delay)
+            results = [handler(value) for value in json.loads(line)]
+            writer.write((json.dumps(results) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(respond, host, port, limit=STREAM_LIMIT)
+
+
+async def _send_in_batches(records, handler, delay=0, **kwargs):
+    server = await serve_records(handler, delay=delay)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        async with RecordBatcher("127.0.0.1", port, **kwargs) as batcher:
+            futures = [await batcher.submit(record) for record in records]
+            return await asyncio.gather(*futures)
+
+
+@settings(max_examples=20, deadline=None)
+@given(st.lists(st.builds(Record, value=json_strat)), st.integers(1, 10))
+def test_record_batcher_matches_service(records, max_batch):
+    def handler(value):
+        return Record(value).to_json(canonical=True)
+
+    results = asyncio.run(
+        _send_in_batches(records, handler, max_batch=max_batch, connections=2)
+    )
+    assert results == [record.to_json(canonical=True) for record in records]
+
+
+def test_record_batcher_survives_cancelled_futures():
+    async def main():
+        server = await serve_records(str, delay=0.05)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            async with RecordBatcher("127.0.0.1", port, connections=1) as batcher:
+                futures = [await batcher.submit(Record(n)) for n in range(3)]
+                futures[0].cancel()
+                return await asyncio.gather(*futures[1:])
+
+    assert asyncio.run(main()) == ["1", "2"]
+
+
+##############################################################################
+
+"""
+Streaming records
+-----------------
+`to_json` and `from_json` work on one document held in memory, but a dump of
+millions of records is better stored as JSON Lines: one compact JSON document
+per line.  We can then write records from any iterable, and read them back
+one at a time - using a background thread to read the next chunks of the
+file while we're decoding this one.
+"""
+
+import queue
+import threading
+from functools import partial
+from io import BytesIO
+
+
+def write_records(records, f):
+    """Write an iterable of Records to a binary file, as JSON Lines."""
+    # Canonical JSON escapes any newlines in strings, so each is one line.
+    f.writelines(r.to_json(canonical=True).encode() + b"\n" for r in records)
+
+
+def read_records(f, chunk_size=2 ** 20, prefetch=2):
+    """Lazily yield the Records in a JSON Lines binary file.
+
+    Memory use is bounded by the size of `prefetch` chunks plus the longest
+    line, no matter how big the file is.  With prefetch=0 we read each chunk
+    only when we need it, instead of in a background thread.
+    """
+    if prefetch:
+        chunks = _read_ahead(f, chunk_size, prefetch)
+    else:
+        chunks = iter(partial(f.read, chunk_size), b"")
+    # Pieces of a line which hasn't ended yet.  We join them only once we
+    # find the newline, so a line longer than chunk_size isn't copied again
+    # for every chunk.
+    pieces = []
+    for chunk in chunks:
+        lines = chunk.split(b"\n")
+        if len(lines) == 1:
+            pieces.append(chunk)
+            continue
+        pieces.append(lines[0])
+        lines[0] = b"".join(pieces)
+        pieces = [lines.pop()]
+        for line in lines:
+            if line:
+                yield Record(json.loads(line))
+    partial_line = b"".join(pieces)
+    if partial_line.strip():
+        yield Record(json.loads(partial_line))
+
+
+def _read_ahead(f, chunk_size, prefetch):
+    """Yield chunks of f, which a background thread reads up to prefetch ahead."""
+    chunks = queue.Queue(prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # Check for `stop` now and then, in case nobody is reading any more.
+        while not stop.is_set():
+            try:
+                return chunks.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def read_chunks():
+        try:
+            for chunk in iter(partial(f.read, chunk_size), b""):
+                put(chunk)
+        except Exception as e:
+            put(e)
+        put(b"")
+
+    thread = threading.Thread(target=read_chunks, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+@settings(deadline=None)  # handing tiny chunks between threads can be slow
+@given(
+    st.lists(st.builds(Record, value=json_strat)),
+    st.integers(1, 100),
+    st.integers(0, 3),
+)
+def test_record_stream_roundtrip(records, chunk_size, prefetch):
+    with BytesIO() as f:
+        write_records(records, f)
+        f.seek(0)
+        new = list(read_records(f, chunk_size, prefetch))
+    assert len(new) == len(records)
+    for record, new_record in zip(records, new):
+        string = record.to_json(canonical=True)
+        assert new_record.to_json(canonical=True) == string
+        # Records containing NaN aren't equal to a copy of themselves!
+        assert new_record == record or "NaN" in string
+
+
+##############################################################################
+
+"""
+Random access to records
+------------------------
+Streaming is great for reading every record, but to get record number N we
+would have to decode all of the records before it.  Instead, we can scan the
+file once to find where each line starts, and save those offsets in a small
+'sidecar' index file next to it.  With the data file memory-mapped, any record
+or slice is then only a lookup away.
+
+The index remembers the size and modification time of the data file it was
+built from, and if either has changed when we open the file we rebuild it.
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+
+RECORD_INDEX_HEADER = struct.Struct("<8sqqq")  # magic, size, mtime_ns, count
+RECORD_INDEX_MAGIC = b"RECIDXv1"
+
+
+class RecordFile(Sequence):
+    """A read-only sequence of the Records in a JSON Lines file.
+
+    The index is saved to `index_path`, which defaults to path + ".idx".
+    It's only an optimisation, so if it can't be saved - say, because the
+    directory is read-only - we keep the offsets in memory and carry on.
+    Use it as a context manager, or call close() when you're done - and
+    don't modify the data file while it's open.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + ".idx"
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            # Empty files can't be memory-mapped, but have no records anyway.
+            self._mmap = stat.st_size and mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        self._offsets = _read_record_index(self.index_path, stat)
+        self.built_index = self._offsets is None
+        if self.built_index:
+            self._offsets = _line_offsets(self._mmap or b"")
+            try:
+                _write_record_index(self.index_path, stat, self._offsets)
+            except OSError:
+                pass
+
+    def __repr__(self):
+        return "<RecordFile {!r} with {} records>".format(self.path, len(self))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        # Each slice may include trailing blank lines, but json.loads
+        # ignores whitespace after the document.
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return Record(json.loads(self._mmap[start:end]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+
+
+def _line_offsets(buffer):
+    """Return the offset of each non-blank line in buffer, then its length."""
+    offsets = array("q")
+    start, size = 0, len(buffer)
+    while start < size:
+        end = buffer.find(b"\n", start)
+        end = size if end == -1 else end + 1
+        if buffer[start] != ord("\n"):
+            offsets.append(start)
+        start = end
+    offsets.append(size)
+    return offsets
+
+
+def _read_record_index(index_path, stat):
+    """Return the offsets saved in index_path, or None if there's no index
+    for this version of the data file."""
+    try:
+        with open(index_path, "rb") as f:
+            header = f.read(RECORD_INDEX_HEADER.size)
+            data = f.read()
+        magic, size, mtime_ns, count = RECORD_INDEX_HEADER.unpack(header)
+    except (OSError, struct.error):
+        return None
+    if (magic, size, mtime_ns) != (RECORD_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns):
+        return None
+    offsets = array("q")
+    if len(data) != offsets.itemsize * (count + 1):
+        return None
+    offsets.frombytes(data)
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    return offsets
+
+
+def _write_record_index(index_path, stat, offsets):
+    header = RECORD_INDEX_HEADER.pack(
+        RECORD_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(offsets) - 1
+    )
+    if sys.byteorder != "little":
+        offsets = array("q", offsets)
+        offsets.byteswap()
+    # As for RecordCache, write then rename so nobody sees a partial index.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header + offsets.tobytes())
+        os.replace(tmp, index_path)
+    except OSError:
+        os.remove(tmp)
+        raise
+
+
+@settings(deadline=None)
+@given(
+    st.lists(st.builds(Record, value=json_strat)),
+    st.lists(st.builds(Record, value=json_strat), min_size=1),
+    st.data(),
+)
+def test_record_file_random_access(records, more_records, data):
+    def check(record_file, records):
+        expected = [r.to_json(canonical=True) for r in records]
+        assert len(record_file) == len(records)
+        if records:
+            i = data.draw(st.integers(-len(records), len(records) - 1), label="i")
+            assert record_file[i].to_json(canonical=True) == expected[i]
+        s = data.draw(st.slices(len(records)), label="slice")
+        assert [r.to_json(canonical=True) for r in record_file[s]] == expected[s]
+        assert [r.to_json(canonical=True) for r in record_file] == expected
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "records.jsonl")
+        with open(path, "wb") as f:
+            write_records(records, f)
+        with RecordFile(path) as record_file:
+            assert record_file.built_index
+            check(record_file, records)
+        with RecordFile(path) as record_file:
+            assert not record_file.built_index
+            check(record_file, records)
+        # If the index can't be saved, we still have it in memory.
+        unwritable = os.path.join(directory, "missing", "records.idx")
+        with RecordFile(path, unwritable) as record_file:
+            assert record_file.built_index
+            check(record_file, records)
+        # Appending to the file changes its size, so the index is rebuilt.
+        with open(path, "ab") as f:
+            write_records(more_records, f)
+        with RecordFile(path) as record_file:
+            assert record_file.built_index
+            check(record_file, records + more_records)
+
+
+##############################################################################
+
+"""
+A binary encoding
+-----------------
+JSON is text, so every float is written out as digits and parsed back again,
+and a big integer costs one byte per decimal digit.  `encode_value` instead
+writes each value as a one-byte tag, then (for strings, ints, lists and dicts)
+a length, then the contents - floats are just their eight IEEE 754 bytes.
+
+`decode_value` reads from a memoryview, so it never copies the buffer it is
+given, and because the encoding is exact we can test the roundtrip with
+`repr` - which tells -0.0 from 0.0, and True from 1.
+"""
+
+_FLOAT = struct.Struct("<d")
+
+
+def encode_value(value):
+    """Encode a JSON-like value as bytes, which decode_value reverses."""
+    out = bytearray()
+    _encode_value(value, out)
+    return bytes(out)
+
+
+def _encode_value(value, out):
+    # Check for bools first, because they are also instances of int.
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        # Enough bytes for the value in two's complement, including a sign bit.
+        length = value.bit_length() // 8 + 1
+        out += b"i"
+        _encode_length(length, out)
+        out += value.to_bytes(length, "little", signed=True)
+    elif isinstance(value, float):
+        out += b"d" + _FLOAT.pack(value)
+    elif isinstance(value, str):
+        out += b"s"
+        _encode_string(value, out)
+    elif isinstance(value, list):
+        out += b"l"
+        _encode_length(len(value), out)
+        for v in value:
+            _encode_value(v, out)
+    elif isinstance(value, dict):
+        out += b"m"
+        _encode_length(len(value), out)
+        for k, v in value.items():
+            _encode_string(k, out)
+            _encode_value(v, out)
+    else:
+        raise TypeError("Cannot encode {!r}".format(value))
+
+
+def _encode_string(string, out):
+    data = string.encode("utf-8", "surrogatepass")
+    _encode_length(len(data), out)
+    out += data
+
+
+def _encode_length(n, out):
+    """Append n as a varint: seven bits per byte, high bit set if more follow."""
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_value(buffer):
+    """Decode a value from bytes or any other buffer made by encode_value."""
+    with memoryview(buffer) as original, original.cast("B") as view:
+        value, pos = _decode_value(view, 0)
+        if pos != len(view):
+            raise ValueError("{} bytes of trailing data".format(len(view) - pos))
+        return value
+
+
+def _decode_value(view, pos):
+    """Return the value starting at view[pos], and the position after it."""
+    _check_size(view, pos, 1, "tag")
+    tag = view[pos]
+    pos += 1
+    if tag == ord("N"):
+        return None, pos
+    if tag == ord("T"):
+        return True, pos
+    if tag == ord("F"):
+        return False, pos
+    if tag == ord("d"):
+        _check_size(view, pos, _FLOAT.size, "float")
+        return _FLOAT.unpack_from(view, pos)[0], pos + _FLOAT.size
+    if tag == ord("s"):
+        return _decode_string(view, pos)
+    if tag in b"ilm":
+        n, pos = _decode_length(view, pos)
+        if tag == ord("i"):
+            _check_size(view, pos, n, "int")
+            return int.from_bytes(view[pos : pos + n], "little", signed=True), pos + n
+        if tag == ord("l"):
+            value = []
+            for _ in range(n):
+                item, pos = _decode_value(view, pos)
+                value.append(item)
+            return value, pos
+        value = {}
+        for _ in range(n):
+            key, pos = _decode_string(view, pos)
+            value[key], pos = _decode_value(view, pos)
+        return value, pos
+    raise ValueError("Unknown tag {!r} at position {}".format(chr(tag), pos - 1))
+
+
+def _decode_string(view, pos):
+    n, pos = _decode_length(view, pos)
+    _check_size(view, pos, n, "string")
+    return str(view[pos : pos + n], "utf-8", "surrogatepass"), pos + n
+
+
+def _decode_length(view, pos):
+    n = shift = 0
+    while True:
+        _check_size(view, pos, 1, "length")
+        byte = view[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _check_size(view, pos, size, what):
+    # Slicing past the end of a memoryview silently gives fewer bytes.
+    if pos + size > len(view):
+        raise ValueError("truncated {} at position {}".format(what, pos))
+
+
+@given(json_strat | st.integers(-(2 ** 200), 2 ** 200), st.data())
+def test_binary_encoding_roundtrip(value, data):
+    encoded = encode_value(value)
+    assert repr(decode_value(encoded)) == repr(value)
+    assert repr(decode_value(bytearray(encoded))) == repr(value)
+    assert encode_value(decode_value(encoded)) == encoded
+    if len(encoded) % 2 == 0:
+        # Buffers of wider items are decoded as their underlying bytes.
+        assert repr(decode_value(memoryview(encoded).cast("H"))) == repr(value)
+    # Decoding every prefix would be quadratic, so we try one at random.
+    end = data.draw(st.integers(0, len(encoded) - 1), label="end")
+    with pytest.raises(ValueError, match="truncated"):
+        decode_value(encoded[:end])
+
+
+##############################################################################
+
+"""
+Hashable records
+----------------
+`Record` instances can't go in a set or be dict keys, because they're mutable
+and don't define `__hash__`, and each one carries a `__dict__`.  A
+`FrozenRecord` uses `__slots__` instead, and works out a hash of its value
+once when it is created.  Comparing two records with different hashes is then
+instant, and we only compare values when the hashes match.
+
+The hash must agree with `==`, so it ignores dict order (and treats 1, 1.0 and
+True alike, just as Python does).  Don't mutate the value of a FrozenRecord!
+"""
+
+
+class FrozenRecord(object):
+    __slots__ = ("value", "_hash")
+
+    def __init__(self, value):
+        object.__setattr__(self, "value", value)
+        object.__setattr__(self, "_hash", _structural_hash(value))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenRecord is immutable")
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        return "FrozenRecord(value={!r})".format(self.value)
+
+    def __eq__(self, other):
+        return (
+            type(self) == type(other)
+            and self._hash == other._hash
+            and self.value == other.value
+        )
+
+    def __hash__(self):
+        return self._hash
+
+    to_json = Record.to_json
+
+
+def _structural_hash(value):
+    if isinstance(value, list):
+        return hash(("list", tuple(_structural_hash(v) for v in value)))
+    if isinstance(value, dict):
+        items = frozenset((k, _structural_hash(v)) for k, v in value.items())
+        return hash(("dict", items))
+    return hash(value)
+
+
+@given(json_strat, json_strat)
+def test_frozen_record_equality_and_hash(a, b):
+    for x, y in [(a, b), (a, _shuffled_copy(a))]:
+        equal = FrozenRecord(x) == FrozenRecord(y)
+        assert equal == (Record(x) == Record(y))
+        if equal:
+            assert hash(FrozenRecord(x)) == hash(FrozenRecord(y))
+    with pytest.raises(AttributeError):
+        FrozenRecord(a).value = b
+
+
+##############################################################################
+# Benchmarks
+#
+# Run `python pbt-101.py` to compare the size and speed of the encodings above.
+
+import timeit
+import tracemalloc
+
+
+def _large_value(seed=0, size=20000):
+    """A large, deterministic, nested value of the kind Record can hold."""
+    rnd = random.Random(seed)
+    return [
+        {
+            "id": i,
+            "name": "item-{}".format(i),
+            "score": rnd.uniform(-1e6, 1e6),
+            "tags": [rnd.choice("abcdefgh") * 3 for _ in range(3)],
+            "nested": {"flag": rnd.random() < 0.5, "value": None},
+        }
+        for i in range(size)
+    ]
+
+
+def benchmark_json_encoding(number=5):
+    record = Record(_large_value())
+    print("{:>12} {:>12} {:>12}".format("encoding", "bytes", "ms"))
+    for name, encode in [
+        ("indented", record.to_json),
+        ("canonical", lambda: record.to_json(canonical=True)),
+    ]:
+        seconds = timeit.timeit(encode, number=number) / number
+        print("{:>12} {:>12} {:>12.1f}".format(name, len(encode()), 1000 * seconds))
+
+
+def benchmark_batching(count=2000, delay=0.002):
+    """Compare records per second sent one at a time or in batches, to a
+    stand-in service which takes `delay` seconds to answer each request."""
+    records = [Record(value) for value in _large_value(size=count)]
+    for name, kwargs in [
+        ("one at a time", dict(max_batch=1, connections=1)),
+        ("batched", dict(max_batch=100, connections=4)),
+    ]:
+        seconds = timeit.timeit(
+            lambda: asyncio.run(_send_in_batches(records, len, delay, **kwargs)),
+            number=1,
+        )
+        print("{}: {:.0f} records/second".format(name, count / seconds))
+
+
+def benchmark_streaming(count=100000):
+    """Compare reading a JSON Lines file lazily with loading it all at once."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "records.jsonl")
+        with open(path, "wb") as f:
+            write_records(map(Record, _large_value(size=count)), f)
+        for name, read in [
+            ("streamed", lambda f: sum(1 for _ in read_records(f))),
+            ("all at once", lambda f: len([Record(v) for v in map(json.loads, f)])),
+        ]:
+            tracemalloc.start()
+            with open(path, "rb") as f:
+                seconds = timeit.timeit(lambda: read(f), number=1)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                "{}: {:.0f} records/second, peak {:.1f} MB".format(
+                    name, count / seconds, peak / 1e6
+                )
+            )
+
+
+def benchmark_binary_encoding(number=5):
+    """Compare the size and roundtrip speed of canonical JSON and binary."""
+    value = _large_value()
+    row = "{:>12} {:>12} {:>12} {:>12}"
+    print(row.format("encoding", "bytes", "encode ms", "decode ms"))
+    for name, encode, decode in [
+        ("json", lambda: Record(value).to_json(canonical=True), json.loads),
+        ("binary", lambda: encode_value(value), decode_value),
+    ]:
+        encoded = encode()
+        encode_seconds = timeit.timeit(encode, number=number) / number
+        decode_seconds = timeit.timeit(lambda: decode(encoded), number=number) / number
+        print(
+            row.format(
+                name,
+                len(encoded),
+                "{:.1f}".format(1000 * encode_seconds),
+                "{:.1f}".format(1000 * decode_seconds),
+            )
+        )
+
+
+def benchmark_frozen_records(count=100000):
+    """Compare memory per instance, and deduplicating by canonical JSON (as we
+    must for Records) with putting FrozenRecords in a set."""
+    values = [item["tags"] for item in _large_value(size=count)]
+    for cls, dedupe in [
+        (Record, lambda rs: {r.to_json(canonical=True): r for r in rs}.values()),
+        (FrozenRecord, set),
+    ]:
+        tracemalloc.start()
+        records = [cls(v) for v in values]
+        size = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+        seconds = timeit.timeit(lambda: dedupe(records), number=1)
+        print(
+            "{}: {:.0f} bytes each, deduplicated {:.0f} records/second".format(
+                cls.__name__, size, count / seconds
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark_json_encoding()
+    benchmark_batching()
+    benchmark_streaming()
+    benchmark_binary_encoding()
+    benchmark_frozen_records()
+
+
 ##############################################################################
 # Done early?  Check out the run-length encoding excercise at
 # https://github.com/DRMacIver/hypothesis-training as a bonus!
@@ -196,11 +196,13 @@ HanoiTest = HanoiSolver.TestCase
 
 # from statistics import mean  # Can't wait for 2020 and the Python 2 EoL :p
 import math
+from collections import defaultdict
 from fractions import Fraction
+from operator import methodcaller
 
 import pytest
 
-from hypothesis import assume, given, strategies as st
+from hypothesis import assume, example, given, strategies as st
 
 
 def mean(data, as_type=Fraction):
@@ -208,10 +210,71 @@ def mean(data, as_type=Fraction):
     # This function is a correct implementation of the arithmetic mean,
     # so that you can test it according to the metamorphic properties of
     # that mathematical equation for integers, floats, and fractions.
+    # Float results are the exact mean, correctly rounded.
     assert as_type in (int, float, Fraction), as_type
     if as_type == int:
-        return sum(int(n) for n in data) // len(data)  # integer division case
-    return sum(as_type(n) for n in data) / len(data)  # float or Fraction case
+        return sum(map(int, data)) // len(data)  # integer division case
+    try:
+        total = exact_sum(data)
+    except (AttributeError, OverflowError, ValueError):
+        # Not a number we can sum exactly as it is, or an infinite or NaN float.
+        nonfinite = [n for n in data if not math.isfinite(n)]
+        if nonfinite:
+            if as_type != float:
+                raise ValueError("mean of infinite or NaN values")
+            return _nonfinite_sum(nonfinite)
+        total = exact_sum([_exact_fraction(n) for n in data])
+    return as_type(Fraction(total) / len(data))  # float or Fraction case
+
+
+def exact_sum(data):
+    """Return the exact sum of the input list, as an int or Fraction.
+
+    Adding up Fractions is slow, because each addition finds a new common
+    denominator.  Instead we add up the numerators for each denominator -
+    there are few distinct denominators for floats, which are all powers of
+    two.  Then we add those sums in pairs over their least common denominator,
+    and those pairs in pairs, and so on, so that the huge numbers only meet at
+    the end - one at a time, the running denominator would be huge throughout.
+    """
+    if set(map(type, data)) <= {int}:
+        return sum(data)
+    numerators = defaultdict(int)
+    for numerator, denominator in map(methodcaller("as_integer_ratio"), data):
+        numerators[denominator] += numerator
+    pairs = [(n, d) for d, n in numerators.items()]
+    while len(pairs) > 1:
+        summed = []
+        for (n1, d1), (n2, d2) in zip(pairs[::2], pairs[1::2]):
+            g = math.gcd(d1, d2)
+            summed.append((n1 * (d2 // g) + n2 * (d1 // g), d1 // g * d2))
+        pairs = summed + pairs[len(summed) * 2 :]
+    return Fraction(*pairs[0])
+
+
+def _exact_fraction(n):
+    # Fraction(numpy.int64(...)) keeps a fixed-width numerator, which would
+    # silently overflow when we add them up.
+    n = Fraction(n)
+    return Fraction(int(n.numerator), int(n.denominator))
+
+
+def _nonfinite_sum(values):
+    # Adding up floats would give a different answer depending on the order,
+    # e.g. [1e308, 1e308, -inf], so we ignore any finite values.  Then the
+    # sum is NaN if there's a NaN or both infinities, otherwise the infinity.
+    if any(map(math.isnan, values)) or (math.inf in values and -math.inf in values):
+        return math.nan
+    return math.copysign(math.inf, values[0])
+
+
+def fraction_mean(data, as_type=Fraction):
+    """The obvious version of mean(), which converts every element to as_type
+    before adding them up.  Slow, and the float version rounds after each
+    addition - but it's easy to trust the Fraction version as an oracle."""
+    if as_type == int:
+        return sum(int(n) for n in data) // len(data)
+    return sum(as_type(n) for n in data) / len(data)
 
 
 # You can use parametrize and given together, but two tips for best results:
@@ -238,3 +301,242 @@ def test_mean_properties(data, type_, strat):
     # TODO: metamorphic test assertions.  For example, how should result
     # change if you add the mean to values?  a number above or below result?
     # Remove some elements from values?
+
+
+numbers = st.integers() | st.floats(allow_nan=False, allow_infinity=False)
+numbers |= st.fractions()
+
+
+@given(st.lists(numbers, min_size=1))
+def test_mean_matches_fraction_mean(values):
+    exact = fraction_mean(values, Fraction)
+    assert mean(values, Fraction) == exact
+    assert mean(values, float) == float(exact)
+    assert mean(values, int) == fraction_mean(values, int)
+
+
+# If the data doesn't fit in memory - or comes from several workers - we can
+# keep exact running totals instead, and combine them at the end.  This gives
+# exactly the same answers as mean() on all the data at once.
+
+
+class MeanAccumulator(object):
+    """Computes mean() over data that arrives in chunks.
+
+    Call `update(chunk)` for each chunk, combine accumulators from different
+    workers with `merge(other)`, and then call `result(as_type)`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0  # exact sum of the finite values
+        self.int_total = 0  # sum of int(n), for result(int)
+        self.nonfinite = None  # _nonfinite_sum() of any infinite or NaN floats
+
+    def __repr__(self):
+        return "<MeanAccumulator of {} values>".format(self.count)
+
+    def update(self, chunk):
+        chunk = list(chunk)
+        self.count += len(chunk)
+        try:
+            self.total += exact_sum(chunk)
+        except (AttributeError, OverflowError, ValueError):
+            # As in mean(), but some chunks might have no non-finite values.
+            finite = [_exact_fraction(n) for n in chunk if math.isfinite(n)]
+            self.total += exact_sum(finite)
+            if len(finite) < len(chunk):
+                nonfinite = [n for n in chunk if not math.isfinite(n)]
+                self._add_nonfinite(_nonfinite_sum(nonfinite))
+                self.int_total = None
+        if self.int_total is not None:
+            self.int_total += sum(map(int, chunk))
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if self.int_total is None or other.int_total is None:
+            self.int_total = None
+        else:
+            self.int_total += other.int_total
+        if other.nonfinite is not None:
+            self._add_nonfinite(other.nonfinite)
+        return self
+
+    def result(self, as_type=Fraction):
+        assert as_type in (int, float, Fraction), as_type
+        if not self.count:
+            raise ZeroDivisionError("mean of no values")
+        if self.nonfinite is not None:
+            if as_type != float:
+                raise ValueError("mean of infinite or NaN values")
+            return self.nonfinite
+        if as_type == int:
+            return self.int_total // self.count
+        return as_type(Fraction(self.total) / self.count)
+
+    def _add_nonfinite(self, value):
+        if self.nonfinite is not None:
+            value = _nonfinite_sum([self.nonfinite, value])
+        self.nonfinite = value
+
+
+@given(
+    st.lists(st.lists(numbers), min_size=1),
+    st.lists(st.floats()),
+    st.integers(0, 100),
+)
+@example(chunks=[[1e308, 1e308]], more_chunk=[-math.inf], split=0)
+def test_mean_accumulator_matches_mean(chunks, more_chunk, split):
+    values = [n for chunk in chunks for n in chunk]
+    assume(values)
+    split %= len(chunks) + 1
+    left, right = MeanAccumulator(), MeanAccumulator()
+    for chunk in chunks[:split]:
+        left.update(chunk)
+    for chunk in chunks[split:]:
+        right.update(iter(chunk))
+    accumulator = left.merge(right)
+    for as_type in (int, float, Fraction):
+        assert accumulator.result(as_type) == mean(values, as_type)
+    # With an infinite or NaN float, only the float mean makes sense.
+    accumulator.update(more_chunk)
+    result = accumulator.result(float)
+    expected = mean(values + more_chunk, float)
+    assert result == expected or math.isnan(result) and math.isnan(expected)
+    if not all(map(math.isfinite, more_chunk)):
+        with pytest.raises(ValueError):
+            accumulator.result(Fraction)
+
+
+@given(st.lists(st.integers(-(2 ** 63), 2 ** 63 - 1), min_size=1))
+def test_mean_accumulator_without_as_integer_ratio(values):
+    # Numpy integers have no .as_integer_ratio(), so mean() falls back to
+    # converting each value - the accumulator should agree.
+    np = pytest.importorskip("numpy")
+    array = np.array(values, dtype=np.int64)
+    accumulator = MeanAccumulator().update(array)
+    for as_type in (int, float, Fraction):
+        assert accumulator.result(as_type) == mean(values, as_type)
+        assert mean(list(array), as_type) == mean(values, as_type)
+
+
+# For billions of values, even exact_sum() on one core is too slow.  Since
+# partial totals merge exactly, we can instead split memory-mapped Numpy files
+# into ranges, have a pool of worker processes each return a MeanAccumulator
+# for their ranges, and merge those - with exactly the same result as mean().
+# Numpy is optional, so we only import it where it's used.
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+
+def parallel_mean(paths, as_type=Fraction, workers=None, chunk_size=2 ** 20):
+    """Return mean(values, as_type) for all the values in one or more .npy
+    files, spreading the work across a pool of worker processes.
+
+    Each worker handles chunk_size values at a time, and workers defaults to
+    the number of CPUs.
+    """
+    import numpy as np
+
+    if isinstance(paths, str):
+        paths = [paths]
+    ranges = []
+    for path in paths:
+        size = np.load(path, mmap_mode="r").size
+        ranges.extend(
+            (path, start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)
+        )
+    accumulator = MeanAccumulator()
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        for partial in pool.map(_accumulate_range, ranges):
+            accumulator.merge(partial)
+    return accumulator.result(as_type)
+
+
+def _accumulate_range(path_start_stop):
+    import numpy as np
+
+    path, start, stop = path_start_stop
+    values = np.load(path, mmap_mode="r").reshape(-1, order="A")
+    return MeanAccumulator().update(values[start:stop].tolist())
+
+
+@settings(max_examples=10, deadline=None)  # starting processes is slow
+@given(st.data(), st.integers(1, 10))
+def test_parallel_mean_matches_mean(data, chunk_size):
+    np = pytest.importorskip("numpy")
+    npst = pytest.importorskip("hypothesis.extra.numpy")
+    arrays = data.draw(
+        st.lists(
+            npst.arrays(
+                st.sampled_from(["int64", "float32", "float64"]),
+                npst.array_shapes(min_dims=0, max_dims=2, min_side=0),
+                elements={"allow_nan": False, "allow_infinity": False},
+            ),
+            min_size=1,
+            max_size=3,
+        )
+    )
+    values = [n for array in arrays for n in array.reshape(-1).tolist()]
+    assume(values)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i, array in enumerate(arrays):
+            paths.append(os.path.join(directory, "{}.npy".format(i)))
+            np.save(paths[-1], array)
+        for as_type in (int, float, Fraction):
+            result = parallel_mean(paths, as_type, workers=2, chunk_size=chunk_size)
+            assert result == mean(values, as_type)
+
+
+##############################################################################
+# Benchmarks
+#
+# Run `python test-the-untestable.py` to time mean() against fraction_mean().
+
+import random
+import timeit
+
+
+def benchmark_mean(size=10 ** 6):
+    """Time mean(data, Fraction) and fraction_mean on each type of input.
+
+    Fractions with few distinct denominators are the easy case, so we also
+    time a fiftieth as many with (almost always) distinct denominators.
+    """
+    rnd = random.Random(0)
+    ints = [rnd.randrange(-(10 ** 9), 10 ** 9) for _ in range(size)]
+    inputs = [
+        ("int", ints),
+        ("float", [rnd.uniform(-1e6, 1e6) for _ in ints]),
+        ("Fraction", [Fraction(n, rnd.randint(1, 99)) for n in ints]),
+        ("distinct", [Fraction(n, rnd.randint(1, 10 ** 6)) for n in ints[::50]]),
+    ]
+    for name, data in inputs:
+        times = [
+            timeit.timeit(lambda: function(data, Fraction), number=1)
+            for function in (fraction_mean, mean)
+        ]
+        print("{:>8}: fraction_mean {:.2f}s, mean {:.2f}s".format(name, *times))
+
+
+def benchmark_parallel_mean(size=10 ** 7, workers=(1, 2, 4, 8)):
+    """Report values per second from parallel_mean as we add workers."""
+    import numpy as np
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "values.npy")
+        np.save(path, np.random.default_rng(0).uniform(-1e6, 1e6, size))
+        for n in workers:
+            seconds = timeit.timeit(lambda: parallel_mean(path, workers=n), number=1)
+            print("{} workers: {:.0f} values/second".format(n, size / seconds))
+
+
+if __name__ == "__main__":
+    benchmark_mean()
+    benchmark_parallel_mean()
@@ -10,7 +10,11 @@ Key link:  https://hypothesis.readthedocs.io/en/latest/data.html
 
 """
 
+import inspect
 import json
+import sys
+from copy import deepcopy
+from functools import wraps
 
 import pytest
 
@@ -60,24 +64,124 @@ def check_schema(schema):
 
 def validate(schema, instance):
     """Return True if `instance` matches `schema`, otherwise False."""
+    # Freezing the schema to look it up costs more than the checks do, so we
+    # first try the validator for this very dict - unless it has changed.
+    seen = _validators_by_id.get(id(schema))
+    if seen is None or seen[1] != schema:
+        if len(_validators_by_id) >= SCHEMA_CACHE_SIZE:
+            del _validators_by_id[next(iter(_validators_by_id))]
+        # Keeping the schema alive means its id can't be reused.
+        seen = (schema, deepcopy(schema), compile_schema(schema))
+        _validators_by_id[id(schema)] = seen
+    return seen[2](instance)
+
+
+_validators_by_id = {}  # id(schema) -> (schema, copy of schema, validator)
+
+
+# Checking the schema and looking up each constraint on every call adds up
+# when we validate millions of instances against a handful of schemas.  So
+# instead we check each schema once, and return a function which only does
+# the type and bound checks.  Equal schemas share a validator, even if their
+# keys are in a different order.  If an array schema has `items`, they are
+# compiled the same way and each element of the array is checked against them.
+# Hold on to the validator for hot loops - it skips the cache lookup too.
+
+
+SCHEMA_CACHE_SIZE = 1024
+
+
+def _cached_by_schema(function):
+    """Decorate `function(schema, ...)` to remember its results for equal
+    arguments, keeping up to SCHEMA_CACHE_SIZE results and forgetting the
+    oldest first."""
+    cache = {}
+    signature = inspect.signature(function)
+
+    @wraps(function)
+    def wrapper(schema, *args, **kwargs):
+        key = (_freeze(schema), args, tuple(sorted(kwargs.items())) if kwargs else ())
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        # On a miss, bind the arguments so that bad ones fail just as they
+        # would undecorated, and e.g. f(s) and f(s, flag=False) share a result.
+        bound = signature.bind(schema, *args, **kwargs)
+        bound.apply_defaults()
+        normalised = (key[0], tuple(bound.arguments.values())[1:], ())
+        if normalised not in cache:
+            _remember(cache, normalised, function(*bound.args, **bound.kwargs))
+        result = cache[normalised]
+        _remember(cache, key, result)
+        return result
+
+    wrapper.cache = cache
+    return wrapper
+
+
+def _remember(cache, key, value):
+    if key not in cache and len(cache) >= SCHEMA_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+
+def _freeze(schema):
+    """Return a hashable form of schema, which is the same for equal schemas."""
+    assert isinstance(schema, dict), schema
+    # Keys are unique, so sorting the items never compares their values.
+    items = sorted(schema.items())
+    for i, (k, v) in enumerate(items):
+        if isinstance(v, dict):
+            items[i] = (k, _freeze(v))
+    return tuple(items)
+
+
+@_cached_by_schema
+def compile_schema(schema):
+    """Return a function `validator(instance) -> bool` for `schema`."""
     check_schema(schema)
-    if schema.get("type") == "null":
-        return instance is None
-    if schema.get("type") == "bool":
-        return isinstance(instance, bool)
-    if schema.get("type") == "number":
-        return isinstance(instance, float) and schema.get(
-            "minimum", float("-inf")
-        ) <= instance <= schema.get("maximum", float("inf"))
+    type_ = schema["type"]
+    if type_ == "null":
+        return lambda instance: instance is None
+    if type_ == "bool":
+        return lambda instance: isinstance(instance, bool)
+    if type_ == "number":
+        low = schema.get("minimum", float("-inf"))
+        high = schema.get("maximum", float("inf"))
+        return lambda instance: isinstance(instance, float) and low <= instance <= high
     # TODO: complete length validation checks for string and array
-    if schema.get("type") == "string":
-        return isinstance(instance, type(u""))
-    return isinstance(instance, list)
+    if type_ == "string":
+        return lambda instance: isinstance(instance, str)
+    items = compile_schema(schema["items"]) if "items" in schema else None
 
+    def validate_array(instance):
+        # Numpy is optional, but if it's not imported we can't have an array.
+        np = sys.modules.get("numpy")
+        if np is not None and isinstance(instance, np.ndarray) and instance.ndim >= 1:
+            # Check it as a batch of one, instead of converting it to a list.
+            return bool(validate_batch(schema, instance[np.newaxis])[0])
+        return isinstance(instance, list) and (
+            items is None or all(map(items, instance))
+        )
 
-def from_schema(schema):
-    """Returns a strategy for objects that match the given schema."""
+    return validate_array
+
+
+# Strategies are immutable, so we can share them between equal schemas too -
+# which saves building them again for every example of test_schema_inference.
+@_cached_by_schema
+def from_schema(schema, numpy_arrays=False):
+    """Returns a strategy for objects that match the given schema.
+
+    If `numpy_arrays=True`, arrays of numbers are generated as 1D Numpy arrays
+    instead of lists - which is much faster for large arrays, and validate()
+    accepts them too.
+    """
     check_schema(schema)
+    items = schema.get("items", {})
+    if numpy_arrays and schema["type"] == "array" and items.get("type") == "number":
+        return _numpy_array_strategy(schema)
     # TODO: actually handle constraints on number/string/array schemas
     return dict(
         null=st.none(),
@@ -88,6 +192,22 @@ def from_schema(schema):
     )[schema["type"]]
 
 
+def _numpy_array_strategy(schema):
+    import numpy as np
+
+    import hypothesis.extra.numpy as npst
+
+    min_size = schema.get("minLength", 0)
+    # Without a maxLength, we choose a modest limit like st.lists() does.
+    max_size = schema.get("maxLength", min_size + 100)
+    elements = st.floats(
+        schema["items"].get("minimum"), schema["items"].get("maximum"), allow_nan=False
+    )
+    # Elements are drawn sparsely on a background of one fill value, so the
+    # cost of each example doesn't grow with the length of the array.
+    return npst.arrays(np.float64, st.integers(min_size, max_size), elements=elements)
+
+
 # `@st.composite` is one way to write this - another would be to define a
 # bare function, and `return st.one_of(st.none(), st.booleans(), ...)` so
 # each strategy can be defined individually.  Use whichever seems more
@@ -111,10 +231,315 @@ def test_schema_inference(data, schema):
 # TODO: write a test that shows validate may return False (maybe a unit test!)
 
 
+@given(st.floats(allow_nan=False), st.floats(allow_nan=False))
+def test_validate_notices_changed_schemas(instance, maximum):
+    schema = {"type": "number"}
+    assert validate(schema, instance)
+    schema["maximum"] = maximum
+    assert validate(schema, instance) == (instance <= maximum)
+    schema["type"] = "null"
+    del schema["maximum"]
+    assert not validate(schema, instance)
+
+
+@given(st.data(), schema_strategy())
+def test_compiled_items_schemas(data, schema):
+    array_schema = {"items": schema, "type": "array"}
+    validator = compile_schema(array_schema)
+    reordered = dict(reversed(list(array_schema.items())))
+    assert validator is compile_schema(reordered)
+    assert from_schema(array_schema) is from_schema(reordered)
+    assert from_schema(schema) is from_schema(schema, False)
+    assert from_schema(schema, False) is from_schema(schema, numpy_arrays=False)
+    with pytest.raises(TypeError):
+        from_schema(schema, True, False)
+    instance = data.draw(st.lists(from_schema(schema)))
+    assert validator(instance)
+    bad_item = data.draw(st.sampled_from([None, True, 0.0, "", []]))
+    assert validator(instance + [bad_item]) == validate(schema, bad_item)
+
+
+@settings(deadline=None)
+@given(st.data(), st.none() | st.floats(allow_nan=False), st.integers(0, 50))
+def test_numpy_array_schemas(data, minimum, length):
+    np = pytest.importorskip("numpy")
+    maximum = data.draw(st.none() | st.floats(minimum, allow_nan=False))
+    items = {"type": "number"}
+    if minimum is not None:
+        items["minimum"] = minimum
+    if maximum is not None:
+        items["maximum"] = maximum
+    schema = {"type": "array", "items": items, "minLength": length}
+    if data.draw(st.booleans()):
+        schema["maxLength"] = data.draw(st.integers(length, 2 * length))
+    array = data.draw(from_schema(schema, numpy_arrays=True))
+    assert isinstance(array, np.ndarray)
+    assert validate(schema, array)
+    assert validate(schema, array.tolist())
+    assert length <= len(array) <= schema.get("maxLength", length + 100)
+
+
+# Validating a batch of numbers
+#
+# Even a compiled validator costs a Python function call per number, which is
+# slow for arrays of millions of values.  For arrays of floats we can check
+# the bounds of every element at once with Numpy instead, and get exactly the
+# same answers as validate() on each element of `values.tolist()`.  For any
+# other dtype - or bounds that a float64 can't represent exactly - we fall back
+# to calling the compiled validator for each element.  Numpy is optional for
+# the rest of this file, so we only import it when it's needed.
+
+
+def validate_batch(schema, values):
+    """Return a boolean array, True where `values[i]` matches `schema`.
+
+    `values` can be anything np.asarray accepts, including buffers.  A number
+    schema checks each element of a 1D array, and an array schema checks each
+    row of a 2D (or higher) array.
+    """
+    import numpy as np
+
+    validator = compile_schema(schema)
+    values = np.asarray(values)
+    assert values.ndim >= 1, values
+    if values.dtype.kind == "f" and values.dtype.itemsize <= 8:
+        mask = _float_batch_mask(schema, values.astype(np.float64, copy=False))
+        if mask is not None:
+            return mask
+    return np.fromiter(map(validator, values.tolist()), bool, count=len(values))
+
+
+def first_invalid(schema, values):
+    """Return the index of the first value which doesn't match, or None."""
+    mask = validate_batch(schema, values)
+    return None if mask.all() else int(mask.argmin())
+
+
+def _float_batch_mask(schema, values):
+    """Return validate_batch(schema, values) for float64 values, or None if
+    we can't compute it exactly with Numpy."""
+    import numpy as np
+
+    if schema["type"] == "number" and values.ndim == 1:
+        low = schema.get("minimum", float("-inf"))
+        high = schema.get("maximum", float("inf"))
+        if not (_is_exact_float(low) and _is_exact_float(high)):
+            return None
+        return (float(low) <= values) & (values <= float(high))
+    if schema["type"] == "array" and values.ndim >= 2:
+        length = values.shape[1]
+        if "items" not in schema:
+            return np.ones(len(values), bool)
+        items = values.reshape((len(values) * length,) + values.shape[2:])
+        items_mask = _float_batch_mask(schema["items"], items)
+        if items_mask is None:
+            return None
+        return items_mask.reshape(values.shape[:2]).all(axis=1)
+    # Floats never match other schemas, and rows never match number schemas.
+    return np.zeros(len(values), bool)
+
+
+def _is_exact_float(bound):
+    try:
+        return float(bound) == bound or bound != bound  # NaN compares the same
+    except OverflowError:
+        return False
+
+
+@given(
+    st.data(),
+    st.sampled_from(["float16", "float32", "float64", "int64", "bool", "object"]),
+    st.lists(st.integers(0, 4), max_size=2),
+)
+def test_validate_batch_matches_validate(data, dtype, row_shape):
+    npst = pytest.importorskip("hypothesis.extra.numpy")
+    bound = st.none() | st.floats() | st.integers() | st.integers(2 ** 53, 2 ** 64)
+    minimum, maximum = data.draw(bound), data.draw(bound)
+    schema = {"type": "number"}
+    if minimum is not None:
+        schema["minimum"] = minimum
+    if maximum is not None:
+        schema["maximum"] = maximum
+    for length in reversed(row_shape):
+        schema = {"type": "array", "items": schema}
+        if data.draw(st.booleans()):
+            schema["minLength"] = data.draw(st.integers(0, length + 1))
+        if data.draw(st.booleans()):
+            schema["maxLength"] = data.draw(st.integers(0, length + 1))
+    values = data.draw(
+        npst.arrays(
+            dtype,
+            [data.draw(st.integers(0, 20))] + row_shape,
+            elements=st.floats(width=16) if dtype == "object" else None,
+        )
+    )
+    expected = [validate(schema, v) for v in values.tolist()]
+    assert validate_batch(schema, values).tolist() == expected
+    assert first_invalid(schema, values) == (
+        expected.index(False) if False in expected else None
+    )
+
+
+# Validating a JSON array as we read it
+#
+# validate() needs the whole instance in memory, which for a huge JSON array
+# on disk is far bigger than the file.  Instead we can decode one item at a
+# time, check it against the items schema, and forget it - so memory use is
+# bounded by the chunk size plus the largest single item.  As a bonus, we
+# stop reading as soon as an item fails, or there are too many items.
+
+import re
+from io import StringIO
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_JSON_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")
+
+
+def validate_json_array(schema, f, chunk_size=2 ** 16):
+    """Return validate(schema, json.load(f)) for an array schema and a text
+    file, without loading the whole array.  Unlike validate(), this also
+    checks the minLength and maxLength of the array.
+
+    Like json.load this raises ValueError for malformed JSON - but only the
+    part of the file before the first invalid item is checked, and we read
+    at most `chunk_size` characters past the first syntax error.
+    """
+    compile_schema(schema)
+    assert schema["type"] == "array", schema
+    items = compile_schema(schema["items"]) if "items" in schema else None
+    low = schema.get("minLength", 0)
+    high = schema.get("maxLength", float("inf"))
+    reader = _JSONReader(f, chunk_size)
+    char = reader.next_char()
+    if not char:
+        raise reader.error("Expecting value")
+    if char != "[":
+        return False  # valid JSON, perhaps, but not an array
+    count = 0
+    if reader.next_char(peek=True) == "]":
+        reader.next_char()
+    else:
+        while True:
+            item = reader.decode()
+            count += 1
+            if count > high or (items is not None and not items(item)):
+                return False
+            char = reader.next_char()
+            if char == "]":
+                break
+            if char != ",":
+                raise reader.error("Expecting ',' delimiter")
+    if reader.next_char() != "":
+        raise reader.error("Extra data")
+    return count >= low
+
+
+class _JSONReader(object):
+    """Decodes JSON values one at a time from a text file, reading
+    `chunk_size` characters at a time as needed."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def next_char(self, peek=False):
+        """Return the next character after any whitespace, or "" at EOF."""
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                char = self.buffer[self.pos : self.pos + 1]
+                self.pos += not peek and bool(char)
+                return char
+            self._read_chunk()
+
+    def decode(self):
+        """Return the next JSON value, after any whitespace."""
+        self.next_char(peek=True)
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as err:
+                # A truncated value fails within a few characters of the end
+                # of the buffer (e.g. at the start of "-Infinit"), or as an
+                # unterminated string; anything else is a real syntax error.
+                if self.eof or (
+                    len(self.buffer) - err.pos > self.chunk_size + len("-Infinity")
+                    and not err.msg.startswith("Unterminated string")
+                ):
+                    raise
+            else:
+                # "12" might be the start of "12.5e3" in the next chunk, so we
+                # read more if a number (the only value ending in a digit) could
+                # continue - otherwise the caller complains about what follows.
+                if (
+                    self.eof
+                    or self.buffer[end - 1] not in "0123456789"
+                    or not _JSON_NUMBER_TAIL.match(self.buffer, end)
+                ):
+                    self.pos = end
+                    return value
+            self._read_chunk()
+
+    def error(self, message):
+        return json.JSONDecodeError(message, self.buffer, self.pos)
+
+    def _read_chunk(self):
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+
+_json_decoder = json.JSONDecoder()
+
+
+@given(
+    st.data(),
+    schema_strategy(),
+    st.lists(st.none() | st.booleans() | st.floats() | st.integers() | st.text())
+    | st.lists(st.lists(st.floats(), max_size=3))
+    | st.none(),
+    st.sampled_from([None, 0, 2]),
+    st.integers(1, 20),
+)
+def test_validate_json_array_matches_validate(data, items, instance, indent, size):
+    schema = {"type": "array", "items": items}
+    if data.draw(st.booleans()):
+        schema["minLength"] = data.draw(st.integers(0, 5))
+    if data.draw(st.booleans()):
+        schema["maxLength"] = data.draw(st.integers(0, 5))
+    expected = validate(schema, instance) and (
+        schema.get("minLength", 0)
+        <= len(instance)
+        <= schema.get("maxLength", float("inf"))
+    )
+    with StringIO(json.dumps(instance, indent=indent)) as f:
+        assert validate_json_array(schema, f, size) == expected
+
+
+@pytest.mark.parametrize(
+    "text", ["", " ", "[1, x", "[1 x", '["a" "b"', '["a"', "[true", "[tru"]
+)
+def test_validate_json_array_stops_at_syntax_errors(text):
+    # Like json.load, empty input is an error.  Malformed JSON should fail
+    # promptly, not after reading the rest of the file.
+    padding = "1" * 10 ** 6 + "]" if text.strip() else ""
+    with StringIO(text + padding) as f:
+        with pytest.raises(json.JSONDecodeError):
+            validate_json_array({"type": "array"}, f, chunk_size=16)
+        assert f.tell() <= len(text) + 3 * 16
+
+
 ##############################################################################
 # Metamorphic testing with pathfinding problems
 
+import heapq
+import random
 from collections import deque
+from itertools import islice
 from string import ascii_uppercase
 
 """How to demonstrate metamorphic testing, without any dependencies?
@@ -153,6 +578,30 @@ def graphs(
     force_path=True,
     edge_cost=False,
 ):
+    if isinstance(keys, int):
+        # Drawing a filtered set per node is far too slow for big graphs, so
+        # for keys=<number of nodes> we draw flat lists of degrees, neighbours
+        # and costs instead - which still shrink toward few edges to node 0.
+        num_nodes = keys
+        degrees = draw(
+            st.lists(st.integers(1, 4), min_size=num_nodes, max_size=num_nodes),
+            label="degrees",
+        )
+        num_edges = sum(degrees)
+        neighbors = st.integers(0, num_nodes - 1 - (not allow_self_links))
+        targets = draw(
+            st.lists(neighbors, min_size=num_edges, max_size=num_edges),
+            label="targets",
+        )
+        costs = [1] * num_edges
+        if edge_cost:
+            costs = draw(
+                st.lists(st.integers(1, 10), min_size=num_edges, max_size=num_edges),
+                label="costs",
+            )
+        return _bulk_graph(
+            degrees, targets, costs, allow_self_links, directed, force_path
+        )
     result = {c: set() for c in keys}
     for i, c in enumerate(keys):
         # The inner strategy for keys (node identifiers) is a sampled_from,
@@ -179,7 +628,70 @@ def graphs(
     return result
 
 
-def breadth_first_search(graph, start, end):
+def random_graph(
+    num_nodes,
+    seed,
+    allow_self_links=True,
+    directed=True,
+    force_path=True,
+    edge_cost=False,
+):
+    """Return a graph like graphs(keys=range(num_nodes), ...), from a seed.
+
+    This is fast enough for millions of nodes, because we draw the number of
+    neighbours for every node and then all the neighbours in bulk, which
+    makes it useful for reproducible benchmarks.  Tests should use graphs(),
+    so that Hypothesis can shrink any failing graph.
+    """
+    assert num_nodes >= 1 + (not allow_self_links), num_nodes
+    rnd = random.Random(seed)
+    degrees = rnd.choices(range(1, 5), k=num_nodes)
+    num_edges = sum(degrees)
+    # Without self-links, we choose from all but one node and skip over self.
+    choices = range(num_nodes if allow_self_links else num_nodes - 1)
+    targets = rnd.choices(choices, k=num_edges)
+    costs = rnd.choices(range(1, 11), k=num_edges) if edge_cost else [1] * num_edges
+    return _bulk_graph(degrees, targets, costs, allow_self_links, directed, force_path)
+
+
+def _bulk_graph(degrees, targets, costs, allow_self_links, directed, force_path):
+    # Node i has the next degrees[i] (target, cost) pairs as its edges.
+    num_nodes = len(degrees)
+    edges = zip(targets, costs)
+    result = {node: set() for node in range(num_nodes)}
+    for node, degree in enumerate(degrees):
+        for neighbor, cost in islice(edges, degree):
+            if not allow_self_links and neighbor >= node:
+                neighbor += 1
+            result[node].add((neighbor, cost))
+            if not directed:
+                result[neighbor].add((node, cost))
+        if force_path:
+            result[node].add(((node - 1) % num_nodes, 1))
+            if not directed:
+                result[(node - 1) % num_nodes].add((node, 1))
+    return result
+
+
+@given(st.data(), st.booleans(), st.booleans(), st.booleans(), st.booleans())
+def test_large_graphs(data, allow_self_links, directed, force_path, edge_cost):
+    num_nodes = data.draw(st.integers(2, 1000), label="num_nodes")
+    graph = data.draw(
+        graphs(num_nodes, allow_self_links, directed, force_path, edge_cost)
+    )
+    assert sorted(graph) == list(range(num_nodes))
+    for node, edges in graph.items():
+        assert edges
+        for neighbor, cost in edges:
+            assert neighbor in graph
+            assert allow_self_links or neighbor != node
+            assert 1 <= cost <= (10 if edge_cost else 1)
+            assert directed or (node, cost) in graph[neighbor]
+    if force_path:
+        assert breadth_first_search(graph, 0, num_nodes - 1) is not None
+
+
+def breadth_first_search(graph, start, end, index=None):
     """Return the lowest-cost path from start to end, as a list of nodes to visit.
 
     If start and end are not connected None will be returned.  If start == end
@@ -196,25 +708,73 @@ def breadth_first_search(graph, start, end):
 
     If there are multiple paths of equal cost, ties are broken by the number
     of nodes, then comparison of differing nodes with lesser winning.
+
+    The graph may also be a CSRGraph, which saves re-sorting the neighbours
+    of each node every time we visit it.  If you pass a ReachabilityIndex for
+    the graph, we can give up on hopeless searches immediately.
     """
     assert start in graph and end in graph
     if start == end:
         return (start,)
     # TODO: implemented cost-aware search if you want an harder problem!
-    seen = set()
-    paths = deque()
-    paths.append((start,))
-    while paths:
-        path_so_far = paths.popleft()
-        current_node = path_so_far[-1]
-        for node, _cost in sorted(graph[current_node]):
-            if node in seen:
+    # Rather than copying the whole path for every node we discover, we keep
+    # a map of each node to the node we first discovered it from, and walk
+    # back along that to rebuild the path once we've found the end.
+    neighbors, node_id, node_of = _adjacency(graph)
+    start, end = node_id(start), node_id(end)
+    if index is not None:
+        if not index.reachable_id(start, end):
+            return None
+        neighbors = index.pruned(neighbors, end)
+    parents = _bfs_parents(neighbors, start, end)
+    if end not in parents:
+        return None
+    return tuple(map(node_of, _walk_back(parents, start, end)))
+
+
+def _bfs_parents(neighbors, start, end=None):
+    """Return a map of each node to the node it was first discovered from,
+    searching until we discover end or (by default) everything reachable."""
+    parents = {start: None}
+    queue = deque([start])
+    while queue:
+        current_node = queue.popleft()
+        for node, _cost in neighbors(current_node):
+            if node in parents:
                 continue
-            seen.add(node)
-            paths.append(path_so_far + (node,))
+            parents[node] = current_node
+            queue.append(node)
             if node == end:
-                return paths[-1][1:]
-    return None
+                return parents
+    return parents
+
+
+def _walk_back(parents, start, end):
+    """Rebuild the path from start to end (excluding start) from a parents map."""
+    path = []
+    while end != start:
+        path.append(end)
+        end = parents[end]
+    return tuple(reversed(path))
+
+
+def _identity(x):
+    return x
+
+
+def _adjacency(graph, ordered=True):
+    """Return (neighbors, node_id, node_of) functions for searching a graph.
+
+    Searches work in terms of node ids, which are the nodes themselves for
+    dict-of-sets graphs, and look up `neighbors(node_id)` to get (id, cost)
+    pairs - sorted, unless ordered=False.  node_id and node_of translate
+    between nodes and their ids, so that searches can accept either format.
+    """
+    if isinstance(graph, CSRGraph):
+        return graph.neighbors, graph.index.__getitem__, graph.nodes.__getitem__
+    if ordered:
+        return (lambda node: sorted(graph[node])), _identity, _identity
+    return graph.__getitem__, _identity, _identity
 
 
 @given(graphs(), st.sampled_from(ascii_uppercase), st.sampled_from(ascii_uppercase))
@@ -227,6 +787,37 @@ def test_bfs_connected(graph, start, end):
     # TODO: try `graphs(force_path=False)`.  What do you expect to happen?
 
 
+def copying_paths_search(graph, start, end):
+    """The obvious version of breadth_first_search, which keeps a whole copy of
+    the path to each node in the queue.  Slow and memory-hungry, but easy to
+    trust - which makes it a useful oracle for the faster version!"""
+    if start == end:
+        return (start,)
+    seen = set()
+    paths = deque([(start,)])
+    while paths:
+        path_so_far = paths.popleft()
+        for node, _cost in sorted(graph[path_so_far[-1]]):
+            if node in seen:
+                continue
+            seen.add(node)
+            paths.append(path_so_far + (node,))
+            if node == end:
+                return paths[-1][1:]
+    return None
+
+
+@given(
+    graphs(force_path=False),
+    st.sampled_from(ascii_uppercase),
+    st.sampled_from(ascii_uppercase),
+)
+def test_bfs_matches_copying_paths_search(graph, start, end):
+    assert breadth_first_search(graph, start, end) == copying_paths_search(
+        graph, start, end
+    )
+
+
 # Re-implementing graph search in twenty minutes is a bit much (this isn't
 # an interview!), so we'll use metamorphic testing instead.  Even with an
 # untrusted searcher, we know that certain properties should hold:
@@ -265,3 +856,1134 @@ def test_bfs_finds_shortest_path(graph, data):
     path = breadth_first_search(graph, start, end)
     midpoint = data.draw(st.sampled_from(path), label="midpoint")
     # TODO: your code here!
+
+
+##############################################################################
+# Cost-aware search
+#
+# Once you're happy with breadth_first_search, here's the harder version:
+# a heap-based (Dijkstra) search which takes edge costs into account, with
+# the same return contract and tie-breaking rule.  The interesting part is
+# the tie-breaking - choosing the cheapest path is the easy bit!
+
+
+def dijkstra_search(graph, start, end):
+    """Return the lowest-cost path from start to end, as a tuple of nodes to visit.
+
+    This has exactly the same contract as breadth_first_search, including the
+    rules for breaking ties, but takes the cost of each edge into account.
+    If every edge costs one, the two functions return identical paths.
+    Runs in O((V + E) log V) time.
+    """
+    assert start in graph and end in graph
+    if start == end:
+        return (start,)
+    neighbors, node_id, node_of = _adjacency(graph, ordered=False)
+    start, end = node_id(start), node_id(end)
+    # First, a standard Dijkstra search for the (cost, number of nodes) of the
+    # best path to every node that's closer than the end.
+    best = {start: (0, 0)}
+    done = {}
+    heap = [(0, 0, start)]
+    while heap:
+        cost, hops, current_node = heapq.heappop(heap)
+        if current_node in done:
+            continue
+        done[current_node] = (cost, hops)
+        if current_node == end:
+            break
+        for node, edge_cost in neighbors(current_node):
+            key = (cost + edge_cost, hops + 1)
+            if node not in done and (node not in best or key < best[node]):
+                best[node] = key
+                heapq.heappush(heap, key + (node,))
+    else:
+        return None
+    # Then break ties between equally good paths.  Every best path with n nodes
+    # extends a best path with n-1 nodes, so we can work out which is the
+    # lexicographically-least path to each node level by level: rank them by
+    # the rank of the path to their parent, then by the node itself.
+    parents = {}
+    rank = {start: 0}
+    level = [start]
+    for _ in range(done[end][1]):
+        reached = set()
+        for parent in level:
+            cost, hops = done[parent]
+            for node, edge_cost in neighbors(parent):
+                if done.get(node) != (cost + edge_cost, hops + 1):
+                    continue
+                if node not in reached or rank[parent] < rank[parents[node]]:
+                    parents[node] = parent
+                    reached.add(node)
+        level = sorted(reached, key=lambda node: (rank[parents[node]], node))
+        rank.update((node, i) for i, node in enumerate(level))
+    return tuple(map(node_of, _walk_back(parents, start, end)))
+
+
+def path_keyed_search(graph, start, end):
+    """An oracle for dijkstra_search, which keeps the whole path in each heap
+    entry so that the heap itself does all the tie-breaking for us."""
+    if start == end:
+        return (start,)
+    seen = set()
+    heap = [(0, 0, ())]
+    while heap:
+        cost, hops, path = heapq.heappop(heap)
+        current_node = path[-1] if path else start
+        if current_node in seen:
+            continue
+        seen.add(current_node)
+        if current_node == end:
+            return path
+        for node, edge_cost in graph[current_node]:
+            heapq.heappush(heap, (cost + edge_cost, hops + 1, path + (node,)))
+    return None
+
+
+@given(graphs(force_path=False), st.data())
+def test_dijkstra_matches_bfs_for_unit_costs(graph, data):
+    start = data.draw(st.sampled_from(sorted(graph)), label="start")
+    end = data.draw(st.sampled_from(sorted(graph)), label="end")
+    assert dijkstra_search(graph, start, end) == breadth_first_search(graph, start, end)
+
+
+@given(graphs(force_path=False, edge_cost=True), st.data())
+def test_dijkstra_matches_path_keyed_search(graph, data):
+    start = data.draw(st.sampled_from(sorted(graph)), label="start")
+    end = data.draw(st.sampled_from(sorted(graph)), label="end")
+    assert dijkstra_search(graph, start, end) == path_keyed_search(graph, start, end)
+
+
+##############################################################################
+# Repeated queries
+#
+# The metamorphic properties above ask for several paths in the same graph,
+# and each call to breadth_first_search starts again from scratch.  If we
+# search everything reachable from a start node instead of stopping at the
+# end, the resulting tree of parents answers a query for *any* end node.
+
+from collections import OrderedDict
+
+
+class ShortestPaths(object):
+    """Answers breadth_first_search queries on a graph from cached BFS trees.
+
+    One tree is computed (lazily) for each start node, and the least-recently
+    used trees are evicted once more than max_cached_nodes are stored.  If you
+    change the graph, do it via add_edge() and remove_edge() so that the
+    affected trees are discarded - or call invalidate() afterwards.
+    """
+
+    def __init__(self, graph, max_cached_nodes=10 ** 6):
+        self.graph = graph
+        self.max_cached_nodes = max_cached_nodes
+        self._trees = OrderedDict()
+        self._cached_nodes = 0
+
+    def __repr__(self):
+        return "<ShortestPaths with {} cached trees>".format(len(self._trees))
+
+    def path(self, start, end):
+        """Return exactly what breadth_first_search(graph, start, end) would."""
+        assert start in self.graph and end in self.graph
+        if start == end:
+            return (start,)
+        neighbors, node_id, node_of = _adjacency(self.graph)
+        start, end = node_id(start), node_id(end)
+        parents = self._tree(neighbors, start)
+        if end not in parents:
+            return None
+        return tuple(map(node_of, _walk_back(parents, start, end)))
+
+    def _tree(self, neighbors, start):
+        if start in self._trees:
+            self._trees.move_to_end(start)
+            return self._trees[start]
+        parents = _bfs_parents(neighbors, start)
+        self._trees[start] = parents
+        self._cached_nodes += len(parents)
+        while self._cached_nodes > self.max_cached_nodes and len(self._trees) > 1:
+            _, evicted = self._trees.popitem(last=False)
+            self._cached_nodes -= len(evicted)
+        return parents
+
+    def add_edge(self, node, neighbor, cost=1):
+        """Add an edge to the graph, discarding any trees that reach node."""
+        assert isinstance(self.graph, dict), "CSRGraph is immutable"
+        self.graph.setdefault(neighbor, set())
+        self.graph.setdefault(node, set()).add((neighbor, cost))
+        self._discard(lambda parents: node in parents)
+
+    def remove_edge(self, node, neighbor, cost=1):
+        """Remove an edge from the graph, discarding any trees that used it."""
+        assert isinstance(self.graph, dict), "CSRGraph is immutable"
+        self.graph[node].discard((neighbor, cost))
+        # If neighbor was discovered from some other node, then that node was
+        # searched first and this edge never affected the tree.
+        self._discard(lambda parents: parents.get(neighbor, node) == node)
+
+    def invalidate(self):
+        """Discard every cached tree, e.g. after changing the graph directly."""
+        self._discard(lambda parents: True)
+
+    def _discard(self, predicate):
+        for start, parents in list(self._trees.items()):
+            if predicate(parents):
+                del self._trees[start]
+                self._cached_nodes -= len(parents)
+
+
+@given(graphs(force_path=False), st.data())
+def test_shortest_paths_matches_bfs(graph, data):
+    nodes = st.sampled_from(sorted(graph))
+    paths = ShortestPaths(graph, max_cached_nodes=data.draw(st.integers(1, 60)))
+    for _ in range(data.draw(st.integers(1, 20))):
+        action = data.draw(st.sampled_from(["path", "add_edge", "remove_edge"]))
+        start, end = data.draw(nodes), data.draw(nodes)
+        if action == "path":
+            assert paths.path(start, end) == breadth_first_search(graph, start, end)
+        else:
+            getattr(paths, action)(start, end)
+
+
+##############################################################################
+# Compact graphs
+#
+# A dict of sets is a lovely format to write tests with, but it's not very
+# efficient: every edge is a tuple object, and searches have to sort the
+# neighbours of each node again every time they visit it.  A compressed
+# sparse row (CSR) graph numbers the nodes in sorted order, and stores the
+# neighbours of node i (sorted once, up front) in targets[offsets[i]:offsets[i+1]],
+# with their costs at the same positions in a parallel array.
+
+from array import array
+from itertools import accumulate
+
+
+class CSRGraph(object):
+    """An array-backed graph, which the search functions accept directly."""
+
+    def __init__(self, nodes, offsets, targets, costs):
+        assert len(offsets) == len(nodes) + 1
+        assert len(targets) == len(costs) == offsets[-1]
+        self.nodes = nodes
+        if nodes == range(len(nodes)):
+            self.index = nodes  # saves building a dict for integer nodes
+        else:
+            self.index = {node: i for i, node in enumerate(nodes)}
+        self.offsets = offsets
+        self.targets = targets
+        self.costs = costs
+
+    def __repr__(self):
+        return "<CSRGraph with {} nodes and {} edges>".format(
+            len(self.nodes), len(self.targets)
+        )
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def neighbors(self, node_id):
+        """Return the sorted (id, cost) pairs for the neighbours of node_id."""
+        lo, hi = self.offsets[node_id], self.offsets[node_id + 1]
+        return zip(self.targets[lo:hi], self.costs[lo:hi])
+
+    @classmethod
+    def from_dict(cls, graph):
+        """Convert from the `{node: {set of (node, cost) tuples}}` format."""
+        nodes = sorted(graph)
+        index = {node: i for i, node in enumerate(nodes)}
+        offsets, targets, costs = array("q", [0]), array("q"), array("q")
+        for node in nodes:
+            for neighbor, cost in sorted(graph[node]):
+                targets.append(index[neighbor])
+                costs.append(cost)
+            offsets.append(len(targets))
+        return cls(nodes, offsets, targets, costs)
+
+    def to_dict(self):
+        """Convert back to the `{node: {set of (node, cost) tuples}}` format."""
+        return {
+            node: {(self.nodes[j], cost) for j, cost in self.neighbors(i)}
+            for i, node in enumerate(self.nodes)
+        }
+
+    def reverse(self):
+        """Return a CSRGraph with the same nodes and every edge reversed."""
+        counts = [0] * (len(self.nodes) + 1)
+        for j in self.targets:
+            counts[j + 1] += 1
+        offsets = array("q", accumulate(counts))
+        position = list(offsets[:-1])
+        targets = array("q", [0]) * len(self.targets)
+        costs = array("q", [0]) * len(self.costs)
+        # Visiting nodes in order keeps each list of reversed edges sorted.
+        for i in range(len(self.nodes)):
+            for j, cost in self.neighbors(i):
+                targets[position[j]] = i
+                costs[position[j]] = cost
+                position[j] += 1
+        return CSRGraph(self.nodes, offsets, targets, costs)
+
+
+@given(graphs(force_path=False, edge_cost=True), st.data())
+def test_searches_accept_csr_graphs(graph, data):
+    csr = CSRGraph.from_dict(graph)
+    assert csr.to_dict() == graph
+    start = data.draw(st.sampled_from(sorted(graph)), label="start")
+    end = data.draw(st.sampled_from(sorted(graph)), label="end")
+    for search in (breadth_first_search, dijkstra_search):
+        assert search(csr, start, end) == search(graph, start, end)
+
+
+##############################################################################
+# Bidirectional search
+#
+# On a large graph, a search from the start node has to visit everything
+# closer than the end node - and there's a lot more of that than there is
+# near *both* the start and the end!  If we search backwards from the end at
+# the same time, over a reversed copy of the graph, we can stop as soon as
+# the two searches meet.  Finding the same canonical path as
+# breadth_first_search when there are ties takes a little more care, though.
+
+
+def reverse_graph(graph):
+    """Return a copy of the graph with every edge reversed, in the same format."""
+    if isinstance(graph, CSRGraph):
+        return graph.reverse()
+    result = {node: set() for node in graph}
+    for node, edges in graph.items():
+        for neighbor, cost in edges:
+            result[neighbor].add((node, cost))
+    return result
+
+
+def bidirectional_search(graph, start, end, reverse=None):
+    """Return exactly what breadth_first_search(graph, start, end) would, by
+    searching forwards from start and backwards from end until they meet.
+
+    If you're making many queries, pass reverse=reverse_graph(graph) to
+    avoid reversing the graph each time.
+    """
+    assert start in graph and end in graph
+    if start == end:
+        return (start,)
+    if reverse is None:
+        reverse = reverse_graph(graph)
+    neighbors, node_id, node_of = _adjacency(graph)
+    forward, _, _ = _adjacency(graph, ordered=False)
+    backward, _, _ = _adjacency(reverse, ordered=False)
+    start, end = node_id(start), node_id(end)
+    # Each search records the distance to every node it finds.  The forward
+    # search also records *every* link to each node from the previous level.
+    # We always expand whichever frontier is smaller, by a whole level, so the
+    # first nodes found by both searches are all on shortest paths.
+    from_start, links, start_frontier = {start: 0}, {start: []}, [start]
+    to_end, end_frontier = {end: 0}, [end]
+    meeting = []
+    while start_frontier and end_frontier and not meeting:
+        if len(start_frontier) <= len(end_frontier):
+            start_frontier = _expand(forward, start_frontier, from_start, links)
+            meeting = [node for node in start_frontier if node in to_end]
+        else:
+            end_frontier = _expand(backward, end_frontier, to_end)
+            meeting = [node for node in end_frontier if node in from_start]
+    if not meeting:
+        return None
+    middle = from_start[meeting[0]]
+    length = middle + to_end[meeting[0]]
+    # Mark the nodes between start and the meeting points which are on some
+    # shortest path, then walk from start taking the least node which is still
+    # on a shortest path at each step - just like breadth_first_search.
+    on_path = set(meeting)
+    todo = list(meeting)
+    while todo:
+        for node in links[todo.pop()]:
+            if node not in on_path:
+                on_path.add(node)
+                todo.append(node)
+    path = [start]
+    for i in range(1, length + 1):
+        for node, _cost in neighbors(path[-1]):
+            if i <= middle:
+                if node in on_path and from_start[node] == i:
+                    break
+            elif to_end.get(node) == length - i:
+                break
+        path.append(node)
+    return tuple(map(node_of, path[1:]))
+
+
+def _expand(neighbors, frontier, distances, links=None):
+    """Search one level further out from frontier, returning the new nodes."""
+    new_frontier = []
+    for node in frontier:
+        distance = distances[node] + 1
+        for neighbor, _cost in neighbors(node):
+            if neighbor not in distances:
+                distances[neighbor] = distance
+                new_frontier.append(neighbor)
+                if links is not None:
+                    links[neighbor] = [node]
+            elif links is not None and distances[neighbor] == distance:
+                links[neighbor].append(node)
+    return new_frontier
+
+
+@given(graphs(force_path=False), st.data())
+def test_bidirectional_search_matches_bfs(graph, data):
+    start = data.draw(st.sampled_from(sorted(graph)), label="start")
+    end = data.draw(st.sampled_from(sorted(graph)), label="end")
+    expected = breadth_first_search(graph, start, end)
+    assert bidirectional_search(graph, start, end) == expected
+    assert bidirectional_search(CSRGraph.from_dict(graph), start, end) == expected
+
+
+##############################################################################
+# Reachability
+#
+# If there's no path from start to end, breadth_first_search only finds out
+# after searching everything it *can* reach - on a big graph, that's slow!
+# Instead, we can precompute the strongly connected components of the graph:
+# sets of nodes which can all reach each other.  Tarjan's algorithm finds
+# them in linear time, and in reverse topological order: every edge between
+# two components goes from a later-numbered one to an earlier one.
+
+
+class ReachabilityIndex(object):
+    """Answers "is there a path from start to end?" for a fixed graph.
+
+    Building the index takes O(V + E) time.  Queries for nodes in the same
+    component, or where the component numbering rules out any path, are
+    answered in O(1) time; the rest search the (much smaller) condensation
+    of the graph, skipping every component which is numbered too low.
+    """
+
+    def __init__(self, graph):
+        neighbors, self._node_id, _ = _adjacency(graph, ordered=False)
+        node_ids = range(len(graph)) if isinstance(graph, CSRGraph) else graph
+        self.component = _strongly_connected_components(node_ids, neighbors)
+        count = max(self.component.values(), default=-1) + 1
+        self.successors = [set() for _ in range(count)]
+        for node in node_ids:
+            here = self.component[node]
+            for neighbor, _cost in neighbors(node):
+                if self.component[neighbor] != here:
+                    self.successors[here].add(self.component[neighbor])
+
+    def __repr__(self):
+        return "<ReachabilityIndex with {} components>".format(len(self.successors))
+
+    def reachable(self, start, end):
+        """Return True if there is a path from start to end, else False."""
+        return self.reachable_id(self._node_id(start), self._node_id(end))
+
+    def reachable_id(self, start, end):
+        """Like reachable(), but for node ids as used by the search functions."""
+        source, target = self.component[start], self.component[end]
+        if source <= target:
+            return source == target
+        seen = {source}
+        todo = [source]
+        while todo:
+            for successor in self.successors[todo.pop()]:
+                if successor == target:
+                    return True
+                if successor > target and successor not in seen:
+                    seen.add(successor)
+                    todo.append(successor)
+        return False
+
+    def pruned(self, neighbors, end):
+        """Wrap a neighbors function to skip nodes that can't possibly reach end.
+
+        Nothing we skip can be on a path to end, so searches still return
+        exactly the same result - they just stop exploring dead ends sooner.
+        """
+        component, target = self.component, self.component[end]
+        return lambda node: [
+            (neighbor, cost)
+            for neighbor, cost in neighbors(node)
+            if component[neighbor] >= target
+        ]
+
+
+def _strongly_connected_components(node_ids, neighbors):
+    """Return a map of each node to its component number, using an iterative
+    version of Tarjan's algorithm (so that deep graphs don't hit the recursion
+    limit).  Components are numbered in reverse topological order."""
+    component = {}
+    index = {}
+    low = {}
+    stack = []
+    count = 0
+    for root in node_ids:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        work = [(root, iter(neighbors(root)))]
+        while work:
+            node, edges = work[-1]
+            for neighbor, _cost in edges:
+                if neighbor not in index:
+                    index[neighbor] = low[neighbor] = len(index)
+                    stack.append(neighbor)
+                    work.append((neighbor, iter(neighbors(neighbor))))
+                    break
+                if neighbor not in component:  # i.e. it's still on the stack
+                    low[node] = min(low[node], index[neighbor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    member = None
+                    while member != node:
+                        member = stack.pop()
+                        component[member] = count
+                    count += 1
+    return component
+
+
+@given(graphs(force_path=False), st.data())
+def test_reachability_index_matches_bfs(graph, data):
+    index = ReachabilityIndex(graph)
+    start = data.draw(st.sampled_from(sorted(graph)), label="start")
+    end = data.draw(st.sampled_from(sorted(graph)), label="end")
+    expected = breadth_first_search(graph, start, end)
+    assert index.reachable(start, end) == (expected is not None)
+    assert breadth_first_search(graph, start, end, index=index) == expected
+    csr = CSRGraph.from_dict(graph)
+    assert breadth_first_search(csr, start, end, ReachabilityIndex(csr)) == expected
+
+
+##############################################################################
+# Growing graphs
+#
+# Metamorphic property 4 says that linking two nodes on the shortest path
+# drops the nodes between them.  More generally, adding an edge can only make
+# paths shorter (or break a tie differently), and only for nodes downstream of
+# the new edge - so rather than searching again from scratch, we can repair
+# just the part of each BFS tree that has changed.
+
+
+class IncrementalPaths(object):
+    """Keeps breadth_first_search results from some start nodes up to date
+    while edges are added to the graph, via add_edge().
+
+    Each insertion only does work for nodes whose path actually changes (and
+    the neighbours of those nodes), plus the cost of comparing tied paths.
+    """
+
+    def __init__(self, graph, sources):
+        assert isinstance(graph, dict), "CSRGraph is immutable"
+        self.graph = graph
+        self._trees = {}
+        for source in sources:
+            parents = _bfs_parents(_adjacency(graph)[0], source)
+            distances = {}
+            for node, parent in parents.items():  # in the order we found them
+                distances[node] = 0 if parent is None else distances[parent] + 1
+            self._trees[source] = (distances, parents)
+
+    def __repr__(self):
+        return "<IncrementalPaths from {}>".format(sorted(self._trees))
+
+    def path(self, source, end):
+        """Return exactly what breadth_first_search(graph, source, end) would."""
+        assert end in self.graph
+        if source == end:
+            return (source,)
+        distances, parents = self._trees[source]
+        if end not in parents:
+            return None
+        return _walk_back(parents, source, end)
+
+    def add_edge(self, node, neighbor, cost=1):
+        """Add an edge to the graph, and update the paths that it changes."""
+        self.graph.setdefault(neighbor, set())
+        self.graph.setdefault(node, set()).add((neighbor, cost))
+        for distances, parents in self._trees.values():
+            if node in distances and _improves(distances, parents, node, neighbor):
+                self._repair(distances, parents, node, neighbor)
+
+    def _repair(self, distances, parents, node, neighbor):
+        # Whenever the path to a node improves, so might the paths to each of
+        # its neighbours.  Working outwards in order of distance means that the
+        # paths we compare when breaking ties are always up to date.
+        parents[neighbor] = node
+        distances[neighbor] = distances[node] + 1
+        heap = [(distances[neighbor], neighbor)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance != distances[node]:
+                continue  # we found an even shorter path after pushing this one
+            for neighbor, _cost in self.graph[node]:
+                if _improves(distances, parents, node, neighbor):
+                    parents[neighbor] = node
+                    distances[neighbor] = distance + 1
+                    heapq.heappush(heap, (distance + 1, neighbor))
+
+
+def _improves(distances, parents, node, neighbor):
+    """Would the path to neighbor via node be better than its current path?
+    (or, if node is already its parent, did the path to neighbor just change?)"""
+    distance = distances[node] + 1
+    if neighbor not in distances or distance < distances[neighbor]:
+        return True
+    if distance > distances[neighbor]:
+        return False
+    parent = parents[neighbor]
+    return parent == node or _path_is_less(parents, node, parent)
+
+
+def _path_is_less(parents, a, b):
+    """Is the path to node a less than the (equally long) path to node b?"""
+    first_difference = (a, b)
+    while a != b:
+        first_difference = (a, b)
+        a, b = parents[a], parents[b]
+    return first_difference[0] < first_difference[1]
+
+
+@given(graphs(force_path=False), st.data())
+def test_incremental_paths_match_bfs(graph, data):
+    nodes = st.sampled_from(sorted(graph))
+    sources = data.draw(st.sets(nodes, min_size=1, max_size=3), label="sources")
+    paths = IncrementalPaths(graph, sources)
+    for node, neighbor in data.draw(st.lists(st.tuples(nodes, nodes), max_size=10)):
+        paths.add_edge(node, neighbor)
+        for source in sources:
+            for end in graph:
+                assert paths.path(source, end) == breadth_first_search(
+                    graph, source, end
+                )
+
+
+##############################################################################
+# Edge files
+#
+# Loading a big graph from disk into a dict of sets can take longer than the
+# searches we wanted to run on it!  Instead, we can store it in a binary file
+# laid out just like a CSRGraph with integer nodes: a header, the offsets
+# array, and then sorted (source, target, cost) records of 64-bit integers.
+# Memory-mapping that file gives us a CSRGraph without reading or copying
+# anything up front - the OS loads pages as the search touches them.
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+EDGE_FILE_HEADER = struct.Struct("<8sqq")  # magic, num_nodes, num_edges
+EDGE_FILE_MAGIC = b"EDGES\x00v1"
+
+
+def write_edge_file(graph, path):
+    """Write a graph with nodes 0..n-1 to path, for reading with EdgeFile."""
+    if not isinstance(graph, CSRGraph):
+        assert sorted(graph) == list(range(len(graph))), "nodes must be 0..n-1"
+        graph = CSRGraph.from_dict(graph)
+    with open(path, "wb") as f:
+        for part in _edge_file_parts(graph):
+            f.write(part)
+
+
+def _edge_file_parts(graph):
+    """Return the contents of an edge file for a CSRGraph, as a list of bytes."""
+    assert sys.byteorder == "little", "edge files are little-endian"
+    records = array("q")
+    for node in range(len(graph)):
+        for neighbor, cost in graph.neighbors(node):
+            records.extend((node, neighbor, cost))
+    return [
+        EDGE_FILE_HEADER.pack(EDGE_FILE_MAGIC, len(graph), len(records) // 3),
+        array("q", graph.offsets).tobytes(),
+        records.tobytes(),
+    ]
+
+
+class EdgeFile(CSRGraph):
+    """A read-only CSRGraph backed by a memory-mapped file from write_edge_file().
+
+    Opening the file takes the same (tiny) time no matter how big the graph
+    is.  Use it as a context manager, or call close() when you're done.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = _edge_buffer_views(self._mmap)
+        offsets, targets, costs = self._views[-3:]
+        CSRGraph.__init__(self, range(len(offsets) - 1), offsets, targets, costs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Every view of the file must be released before we can unmap it.
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+
+
+def _edge_buffer_views(buffer):
+    """Return memoryviews of an edge file buffer, ending with the offsets,
+    targets, and costs arrays (which are all views of the same buffer)."""
+    assert sys.byteorder == "little", "edge files are little-endian"
+    magic, num_nodes, num_edges = EDGE_FILE_HEADER.unpack_from(buffer)
+    assert magic == EDGE_FILE_MAGIC, "not an edge file: {!r}".format(magic)
+    start = EDGE_FILE_HEADER.size
+    end = start + 8 * (num_nodes + 1 + 3 * num_edges)
+    assert len(buffer) >= end, "edge file is truncated"
+    data = memoryview(buffer)[start:end].cast("q")
+    offsets = data[: num_nodes + 1]
+    records = data[num_nodes + 1 :]
+    return [data, records, offsets, records[1::3], records[2::3]]
+
+
+@given(graphs(60, force_path=False, edge_cost=True), st.data())
+def test_edge_file_round_trip(graph, data):
+    start = data.draw(st.sampled_from(sorted(graph)), label="start")
+    end = data.draw(st.sampled_from(sorted(graph)), label="end")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "graph.edges")
+        write_edge_file(graph, path)
+        with EdgeFile(path) as edges:
+            assert edges.to_dict() == graph
+            for search in (breadth_first_search, dijkstra_search, bidirectional_search):
+                assert search(edges, start, end) == search(graph, start, end)
+
+
+##############################################################################
+# Parallel queries
+#
+# Each process in a pool would normally get its own copy of the graph - which
+# is slow to send, and multiplies the memory we need.  Instead, we write the
+# graph into shared memory once, in the same layout as an edge file, and each
+# worker process wraps that in a CSRGraph without copying anything.
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+
+def parallel_search(graph, queries, workers=None, search=breadth_first_search):
+    """Return [search(graph, start, end) for start, end in queries], in order,
+    spreading the queries across a pool of worker processes.
+
+    search can be any of the search functions which accept a CSRGraph, and
+    workers defaults to the number of CPUs.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.from_dict(graph)
+    queries = [(graph.index[start], graph.index[end]) for start, end in queries]
+    workers = workers or os.cpu_count()
+    parts = _edge_file_parts(graph)
+    memory = SharedMemory(create=True, size=sum(map(len, parts)))
+    try:
+        position = 0
+        for part in parts:
+            memory.buf[position : position + len(part)] = part
+            position += len(part)
+        with ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(memory.name, search)
+        ) as pool:
+            chunksize = max(1, len(queries) // (4 * workers))
+            results = list(pool.map(_search_in_worker, queries, chunksize=chunksize))
+    finally:
+        memory.close()
+        memory.unlink()
+    return [
+        None if path is None else tuple(map(graph.nodes.__getitem__, path))
+        for path in results
+    ]
+
+
+_worker_state = {}
+
+
+def _init_worker(name, search):
+    try:  # Python 3.13+ can attach without registering with the resource tracker
+        memory = SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = SharedMemory(name=name)
+    offsets, targets, costs = _edge_buffer_views(memory.buf)[-3:]
+    _worker_state.update(
+        memory=memory,  # which must outlive the views of it
+        graph=CSRGraph(range(len(offsets) - 1), offsets, targets, costs),
+        search=search,
+    )
+
+
+def _search_in_worker(query):
+    return _worker_state["search"](_worker_state["graph"], *query)
+
+
+@settings(max_examples=10, deadline=None)  # starting processes is slow
+@given(graphs(force_path=False), st.data())
+def test_parallel_search_matches_bfs(graph, data):
+    nodes = st.sampled_from(sorted(graph))
+    queries = data.draw(st.lists(st.tuples(nodes, nodes), max_size=50))
+    expected = [breadth_first_search(graph, start, end) for start, end in queries]
+    assert parallel_search(graph, queries, workers=2) == expected
+
+
+##############################################################################
+# Benchmarks
+#
+# Run `python tough-bonus-problems.py` to time the search functions above on
+# randomly generated graphs of increasing size.
+
+import pickle
+import timeit
+import tracemalloc
+
+
+def benchmark_search(sizes=(1000, 10000, 100000), queries=20):
+    """Compare breadth_first_search with dijkstra_search as graphs grow,
+    on both dict-of-sets and CSR graphs (ms per query)."""
+    searches = [("bfs", breadth_first_search), ("dijkstra", dijkstra_search)]
+    columns = ["{}{}".format(n, f) for n, _ in searches for f in ("", " csr")]
+    print(("{:>8}" + " {:>12}" * len(columns)).format("nodes", *columns))
+    for size in sizes:
+        graph = random_graph(size, seed=size, edge_cost=True)
+        csr = CSRGraph.from_dict(graph)
+        rnd = random.Random(0)
+        pairs = [(rnd.randrange(size), rnd.randrange(size)) for _ in range(queries)]
+        timings = [
+            timeit.timeit(lambda: [search(g, s, e) for s, e in pairs], number=1)
+            for _, search in searches
+            for g in (graph, csr)
+        ]
+        print(
+            ("{:>8}" + " {:>12.2f}" * len(timings)).format(
+                size, *(1000 * t / queries for t in timings)
+            )
+        )
+
+
+def benchmark_graph_memory(sizes=(1000, 10000, 100000)):
+    """Compare the memory used by dict-of-sets and CSR graphs."""
+    print("{:>8} {:>12} {:>12}".format("nodes", "dict (MB)", "csr (MB)"))
+    for size in sizes:
+        tracemalloc.start()
+        graph = random_graph(size, seed=size, edge_cost=True)
+        dict_size = tracemalloc.get_traced_memory()[0]
+        CSRGraph.from_dict(graph)  # immediately discarded, but traced
+        csr_size = tracemalloc.get_traced_memory()[1] - dict_size
+        tracemalloc.stop()
+        print("{:>8} {:>12.2f} {:>12.2f}".format(size, dict_size / 1e6, csr_size / 1e6))
+
+
+def benchmark_repeated_queries(size=100000, starts=5, queries=200):
+    """Compare fresh searches with ShortestPaths for many queries per start."""
+    graph = random_graph(size, seed=size)
+    rnd = random.Random(0)
+    pairs = [
+        (start, rnd.randrange(size))
+        for start in rnd.sample(range(size), starts)
+        for _ in range(queries // starts)
+    ]
+    fresh = timeit.timeit(
+        lambda: [breadth_first_search(graph, s, e) for s, e in pairs], number=1
+    )
+    paths = ShortestPaths(graph)
+    cached = timeit.timeit(lambda: [paths.path(s, e) for s, e in pairs], number=1)
+    print(
+        "{} queries from {} starts on {} nodes: fresh {:.2f}s, cached {:.2f}s".format(
+            len(pairs), starts, size, fresh, cached
+        )
+    )
+
+
+class _CountingGraph(dict):
+    """A graph which counts how many times we look up a node's neighbours."""
+
+    lookups = 0
+
+    def __getitem__(self, node):
+        self.lookups += 1
+        return dict.__getitem__(self, node)
+
+
+def benchmark_bidirectional(sizes=(1000, 10000, 100000), queries=20):
+    """Compare how many nodes BFS and bidirectional search expand per query."""
+    print(
+        "{:>8} {:>12} {:>12} {:>12} {:>12}".format(
+            "nodes", "bfs nodes", "bidi nodes", "bfs (ms)", "bidi (ms)"
+        )
+    )
+    for size in sizes:
+        graph = random_graph(size, seed=size)
+        reverse = reverse_graph(graph)
+        rnd = random.Random(0)
+        pairs = [(rnd.randrange(size), rnd.randrange(size)) for _ in range(queries)]
+        counting, counting_reverse = _CountingGraph(graph), _CountingGraph(reverse)
+        for s, e in pairs:
+            breadth_first_search(counting, s, e)
+        bfs_lookups, counting.lookups = counting.lookups, 0
+        for s, e in pairs:
+            bidirectional_search(counting, s, e, reverse=counting_reverse)
+        bidi_lookups = counting.lookups + counting_reverse.lookups
+        bfs_time = timeit.timeit(
+            lambda: [breadth_first_search(graph, s, e) for s, e in pairs], number=1
+        )
+        bidi_time = timeit.timeit(
+            lambda: [bidirectional_search(graph, s, e, reverse) for s, e in pairs],
+            number=1,
+        )
+        print(
+            "{:>8} {:>12.0f} {:>12.0f} {:>12.2f} {:>12.2f}".format(
+                size,
+                bfs_lookups / queries,
+                bidi_lookups / queries,
+                1000 * bfs_time / queries,
+                1000 * bidi_time / queries,
+            )
+        )
+
+
+def benchmark_reachability(sizes=(10000, 100000, 1000000), queries=20):
+    """Time building a ReachabilityIndex, and queries with no path."""
+    print(
+        "{:>8} {:>9} {:>10} {:>14} {:>14}".format(
+            "nodes", "edges", "build (s)", "bfs (ms)", "indexed (ms)"
+        )
+    )
+    for size in sizes:
+        graph = random_graph(size, seed=size, force_path=False)
+        build = timeit.timeit(lambda: ReachabilityIndex(graph), number=1)
+        index = ReachabilityIndex(graph)
+        rnd = random.Random(0)
+        pairs = []
+        while len(pairs) < queries:
+            s, e = rnd.randrange(size), rnd.randrange(size)
+            if not index.reachable(s, e):
+                pairs.append((s, e))
+        plain, indexed = [
+            timeit.timeit(
+                lambda: [breadth_first_search(graph, s, e, i) for s, e in pairs],
+                number=1,
+            )
+            for i in (None, index)
+        ]
+        print(
+            "{:>8} {:>9} {:>10.2f} {:>14.3f} {:>14.3f}".format(
+                size,
+                sum(map(len, graph.values())),
+                build,
+                1000 * plain / queries,
+                1000 * indexed / queries,
+            )
+        )
+
+
+def benchmark_incremental(size=100000, sources=5, insertions=20):
+    """Compare IncrementalPaths with recomputing BFS trees after each new edge."""
+    graph = random_graph(size, seed=size)
+    rnd = random.Random(0)
+    starts = rnd.sample(range(size), sources)
+    edges = [(rnd.randrange(size), rnd.randrange(size)) for _ in range(insertions)]
+    paths = IncrementalPaths({k: set(v) for k, v in graph.items()}, starts)
+    incremental = timeit.timeit(
+        lambda: [paths.add_edge(*edge) for edge in edges], number=1
+    )
+
+    def recompute():
+        for node, neighbor in edges:
+            graph[node].add((neighbor, 1))
+            for start in starts:
+                _bfs_parents(_adjacency(graph)[0], start)
+
+    from_scratch = timeit.timeit(recompute, number=1)
+    print(
+        "{} insertions, {} sources, {} nodes: incremental {:.3f}s, "
+        "recomputed {:.3f}s".format(
+            insertions, sources, size, incremental, from_scratch
+        )
+    )
+
+
+def benchmark_generation(sizes=(10000, 100000, 1000000)):
+    """Time generating seeded random graphs, as the benchmarks below do."""
+    for size in sizes:
+        seconds = timeit.timeit(lambda: random_graph(size, seed=size), number=1)
+        print("generated {} nodes in {:.2f}s".format(size, seconds))
+
+
+def benchmark_edge_files(sizes=(10000, 100000, 1000000), queries=5):
+    """Compare opening an edge file with unpickling a dict-of-sets graph."""
+    print(
+        "{:>8} {:>12} {:>12} {:>14} {:>14}".format(
+            "nodes", "pickle (s)", "mmap (ms)", "bfs dict (ms)", "bfs mmap (ms)"
+        )
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            graph = random_graph(size, seed=size)
+            with open(os.path.join(tmp, "graph.pickle"), "wb") as f:
+                pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+            write_edge_file(graph, os.path.join(tmp, "graph.edges"))
+            del graph
+
+            def load_pickle():
+                with open(os.path.join(tmp, "graph.pickle"), "rb") as f:
+                    return pickle.load(f)
+
+            unpickle = timeit.timeit(load_pickle, number=1)
+            open_mmap = timeit.timeit(
+                lambda: EdgeFile(os.path.join(tmp, "graph.edges")).close(), number=1
+            )
+            rnd = random.Random(0)
+            pairs = [(rnd.randrange(size), rnd.randrange(size)) for _ in range(queries)]
+            graph = load_pickle()
+            with EdgeFile(os.path.join(tmp, "graph.edges")) as edges:
+                searches = [
+                    timeit.timeit(
+                        lambda: [breadth_first_search(g, s, e) for s, e in pairs],
+                        number=1,
+                    )
+                    for g in (graph, edges)
+                ]
+            print(
+                "{:>8} {:>12.3f} {:>12.3f} {:>14.2f} {:>14.2f}".format(
+                    size,
+                    unpickle,
+                    1000 * open_mmap,
+                    *(1000 * t / queries for t in searches)
+                )
+            )
+
+
+def benchmark_parallel(size=100000, queries=200, workers=(1, 2, 4, 8)):
+    """Report queries per second from parallel_search as we add workers."""
+    graph = random_graph(size, seed=size)
+    rnd = random.Random(0)
+    pairs = [(rnd.randrange(size), rnd.randrange(size)) for _ in range(queries)]
+    for n in workers:
+        seconds = timeit.timeit(lambda: parallel_search(graph, pairs, n), number=1)
+        print("{} workers: {:.1f} queries/second".format(n, queries / seconds))
+
+
+def _baseline_validate(schema, instance):
+    # validate() as it was before compile_schema, for number schemas.
+    check_schema(schema)
+    return isinstance(instance, float) and schema.get(
+        "minimum", float("-inf")
+    ) <= instance <= schema.get("maximum", float("inf"))
+
+
+def benchmark_validation(count=10 ** 6):
+    """Compare validate() with its baseline version, a compiled validator,
+    and validate_batch()."""
+    schema = {"type": "number", "minimum": 0.0, "maximum": 1.0}
+    rnd = random.Random(0)
+    instances = [rnd.uniform(-0.5, 1.5) for _ in range(count)]
+    import numpy as np
+
+    array = np.array(instances)
+    validator = compile_schema(schema)
+    for name, check_all in [
+        ("baseline", lambda: sum(_baseline_validate(schema, x) for x in instances)),
+        ("validate", lambda: sum(validate(schema, x) for x in instances)),
+        ("compiled", lambda: sum(map(validator, instances))),
+        ("batch", lambda: validate_batch(schema, array).sum()),
+    ]:
+        seconds = timeit.timeit(check_all, number=1)
+        print("{}: {:.0f} instances/second".format(name, count / seconds))
+
+
+def benchmark_json_array_validation(sizes=(10 ** 4, 10 ** 5, 10 ** 6)):
+    """Compare json.load() then validate() with validate_json_array(), on
+    files of random floats (peak memory in MB, and time in seconds)."""
+    schema = {"type": "array", "items": {"type": "number", "minimum": 0.0}}
+    row = "{:>8} {:>10} {:>10} {:>10} {:>10}"
+    print(row.format("items", "load MB", "load s", "stream MB", "stream s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "array.json")
+        for size in sizes:
+            rnd = random.Random(size)
+            with open(path, "w") as f:
+                json.dump([rnd.random() for _ in range(size)], f)
+            results = []
+            for check in [
+                lambda f: validate(schema, json.load(f)),
+                lambda f: validate_json_array(schema, f),
+            ]:
+                with open(path) as f:
+                    seconds = timeit.timeit(lambda: check(f), number=1)
+                tracemalloc.start()
+                with open(path) as f:
+                    check(f)
+                results += [tracemalloc.get_traced_memory()[1] / 1e6, seconds]
+                tracemalloc.stop()
+            print(row.format(size, *("{:.2f}".format(r) for r in results)))
+
+
+def benchmark_from_schema(count=10 ** 5):
+    """Compare building strategies with from_schema() with and without the
+    cache, for a few schemas (calls per second)."""
+    schemas = [
+        {"type": "number", "minimum": 0.0, "maximum": 1.0},
+        {"type": "string", "maxLength": 10},
+        {"type": "array", "items": {"type": "bool"}},
+    ]
+    for name, build in [("uncached", from_schema.__wrapped__), ("cached", from_schema)]:
+        seconds = timeit.timeit(lambda: [build(s) for s in schemas], number=count)
+        print("{}: {:.0f} calls/second".format(name, count * len(schemas) / seconds))
+
+
+def benchmark_array_generation(sizes=(100, 1000, 10 ** 4, 10 ** 5), examples=20):
+    """Compare generating arrays of numbers as lists of floats, and with
+    from_schema(..., numpy_arrays=True) (examples per second)."""
+    for size in sizes:
+        items = {"type": "number", "minimum": 0.0, "maximum": 1.0}
+        schema = {"type": "array", "items": items, "minLength": size, "maxLength": size}
+        for name, strategy in [
+            ("lists", st.lists(st.floats(0.0, 1.0), min_size=size, max_size=size)),
+            ("numpy", from_schema(schema, numpy_arrays=True)),
+        ]:
+
+            @settings(
+                max_examples=examples,
+                database=None,
+                deadline=None,
+                phases=[hypothesis.Phase.generate],
+                suppress_health_check=list(hypothesis.HealthCheck),
+            )
+            @given(strategy)
+            def generate(value):
+                pass
+
+            try:
+                seconds = timeit.timeit(generate, number=1)
+                result = "{:.0f} examples/second".format(examples / seconds)
+            except hypothesis.errors.HypothesisException as e:
+                result = "failed with {}".format(type(e).__name__)
+            print("{:>8} {}: {}".format(size, name, result))
+
+
+if __name__ == "__main__":
+    benchmark_generation()
+    benchmark_search()
+    benchmark_graph_memory()
+    benchmark_repeated_queries()
+    benchmark_bidirectional()
+    benchmark_reachability()
+    benchmark_incremental()
+    benchmark_edge_files()
+    benchmark_parallel()
+    benchmark_validation()
+    benchmark_json_array_validation()
+    benchmark_from_schema()
+    benchmark_array_generation()